@@ -0,0 +1,116 @@
+"""Record the latency of external calls, such as CLI subprocesses and HTTP requests.
+
+Recording is disabled until enable() is called, usually because the --profile
+option added by add_arguments() was provided. Calls are then recorded by name
+(e.g. "juju status" or "contract show-contract"), and a table with counts,
+failures and latency percentiles for each name is printed to stderr when the
+process exits. Each call can also be written to a JSON lines trace file.
+"""
+
+import atexit
+import contextlib
+import json
+import math
+import sys
+import threading
+import time
+
+
+_profile = None
+
+
+class Profile:
+    """Thread safe latency statistics for calls, optionally traced to the file at the given path."""
+
+    def __init__(self, trace_path=None):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._trace = open(trace_path, 'w') if trace_path else None
+
+    def record(self, name, start, elapsed, failed, detail=None):
+        """Record a call with the given name, started at the given epoch time and taking elapsed seconds."""
+        with self._lock:
+            data = self._calls.setdefault(name, [[], 0])
+            data[0].append(elapsed)
+            data[1] += failed
+            if self._trace is not None:
+                self._trace.write(json.dumps({
+                    'name': name,
+                    'detail': detail,
+                    'start': start,
+                    'elapsed': elapsed,
+                    'failed': failed,
+                }) + '\n')
+
+    def report(self, file=None):
+        """Print statistics for each call name, the most time consuming first."""
+        file = sys.stderr if file is None else file
+        with self._lock:
+            calls = sorted(self._calls.items(), key=lambda item: -sum(item[1][0]))
+            calls = [(name, sorted(elapsed), failed) for name, (elapsed, failed) in calls]
+        if not calls:
+            return
+        print('{:<32} {:>6} {:>6} {:>9} {:>8} {:>8} {:>8}'.format(
+            'call', 'calls', 'failed', 'total', 'p50', 'p95', 'max'), file=file)
+        for name, elapsed, failed in calls:
+            print('{:<32} {:>6} {:>6} {:>8.2f}s {:>7.3f}s {:>7.3f}s {:>7.3f}s'.format(
+                name, len(elapsed), failed, sum(elapsed),
+                _percentile(elapsed, 50), _percentile(elapsed, 95), elapsed[-1]), file=file)
+
+    def close(self):
+        """Print the report and close the trace file if any."""
+        self.report()
+        if self._trace is not None:
+            self._trace.close()
+
+
+def _percentile(values, percent):
+    """Return the given percentile of the given sorted values, using the nearest rank method."""
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def enable(trace_path=None):
+    """Start recording calls, reporting them when the process exits, and return the profile.
+
+    If a trace path is provided, also write each call to that file.
+    """
+    global _profile
+    if _profile is None:
+        _profile = Profile(trace_path)
+        atexit.register(_profile.close)
+    return _profile
+
+
+@contextlib.contextmanager
+def timed(name, detail=None):
+    """Record the call executed in the context with the given name, if recording is enabled.
+
+    The call fails if the context raises an exception. The optional detail,
+    e.g. the call arguments, is only included in the trace.
+    """
+    if _profile is None:
+        yield
+        return
+    start, started = time.time(), time.monotonic()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        _profile.record(name, start, time.monotonic() - started, failed, detail=detail)
+
+
+def add_arguments(parser):
+    """Add the --profile and --profile-trace options to the given argument parser."""
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='print the latency of external calls to stderr on exit')
+    parser.add_argument(
+        '--profile-trace', metavar='PATH',
+        help='also write each external call to the given JSON lines file (implies --profile)')
+
+
+def setup(args):
+    """Enable recording calls if requested by the options added with add_arguments."""
+    if args.profile or args.profile_trace:
+        enable(args.profile_trace)
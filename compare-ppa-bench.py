@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+
+"""Benchmark the hot paths of compare-ppa.py."""
+
+# This script requires python3 and the requests package to be installed.
+
+import argparse
+from collections import namedtuple
+from concurrent import futures
+import contextlib
+import functools
+import gzip
+import hashlib
+import http.server
+import importlib.util
+import io
+import lzma
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+
+# The path to the compare-ppa.py script being benchmarked.
+_COMPARE_PPA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compare-ppa.py')
+_DEFAULT_PACKAGES = 100000
+_DEFAULT_REPEAT = 3
+_DEFAULT_ARCHES = ['amd64', 'arm64', 'i386']
+_DEFAULT_ARCHIVE_PACKAGES = 10000
+_DEFAULT_ARCHIVE_SUITES = ['xenial', 'bionic']
+_DEFAULT_ARCHIVE_COMPONENTS = ['main']
+# Map compressions of the synthetic archive indexes to file extensions and
+# compression functions.
+_COMPRESSORS = {
+    'none': ('', lambda data: data),
+    'gz': ('.gz', gzip.compress),
+    'xz': ('.xz', lzma.compress),
+}
+_LegacyPackage = namedtuple('Package', 'name path version arch sha')
+
+
+def load_compare_ppa():
+    """Import and return the compare-ppa.py script as a module."""
+    spec = importlib.util.spec_from_file_location('compare_ppa', _COMPARE_PPA_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_index(num_packages, arch='amd64', version='1.0', salt='', salt_every=1):
+    """Return the content of a synthetic uncompressed Packages index as bytes.
+
+    Stanzas include the fields usually found in Launchpad PPAs, with multiline
+    values for dependencies and descriptions. The given salt is used to change
+    the checksum of one package every salt_every packages.
+    """
+    stanzas = []
+    for num in range(num_packages):
+        name = f'package{num}'
+        source = f'source{num // 4}'
+        package_salt = salt if num % salt_every == 0 else ''
+        sha = hashlib.sha256(f'{name} {version} {arch} {package_salt}'.encode('utf8')).hexdigest()
+        stanzas.append(
+            f'Package: {name}\n'
+            f'Architecture: {arch}\n'
+            f'Version: {version}\n'
+            f'Priority: optional\n'
+            f'Section: utils\n'
+            f'Source: {source}\n'
+            f'Maintainer: Ubuntu Developers <ubuntu-devel-discuss@lists.ubuntu.com>\n'
+            f'Installed-Size: {num % 4096}\n'
+            f'Depends: libc6 (>= 2.14), libssl1.1 (>= 1.1.0),\n'
+            f' zlib1g (>= 1:1.1.4)\n'
+            f'Filename: pool/main/{source[0]}/{source}/{name}_{version}_{arch}.deb\n'
+            f'Size: {num * 7 % 100000}\n'
+            f'MD5sum: {sha[:32]}\n'
+            f'SHA1: {sha[:40]}\n'
+            f'SHA256: {sha}\n'
+            f'Description: synthetic package number {num}\n'
+            f' This package is generated for benchmarking purposes.\n'
+            f' .\n'
+            f' It does not include anything useful.\n'
+        )
+    return '\n'.join(stanzas).encode('utf8') + b'\n'
+
+
+def legacy_parse(file, arches):
+    """Extract packages from the given Packages file object, line by line.
+
+    This is the parser originally included in compare-ppa.py, kept here as a
+    baseline for measuring parsing throughput. Its results compare equal to
+    the ones of the current parser.
+    """
+    packages = set()
+    name = path = version = arch = sha = ''
+    for line in file:
+        line = line.decode('utf8').strip()
+        if line.startswith('Package: '):
+            name = line.split()[1]
+        if line.startswith('Filename: '):
+            path = line.split()[1]
+        if line.startswith('Version: '):
+            version = line.split()[1]
+        if line.startswith('Architecture: '):
+            arch = line.split()[1]
+        if line.startswith('SHA256: '):
+            sha = line.split()[1]
+        if not line:
+            if (arches is None) or (arch in arches):
+                packages.add(_LegacyPackage(name, path, version, arch, sha))
+            name = path = version = arch = sha = ''
+    return packages
+
+
+def legacy_compare(packages1, packages2):
+    """Compare two sets of package objects and return added, removed and changed packages.
+
+    This is the comparison originally included in compare-ppa.py, kept here as
+    a baseline for measuring memory usage.
+    """
+    common = packages1 & packages2
+    packages1 -= common
+    packages2 -= common
+    paths1 = {package.path for package in packages1}
+    paths2 = {package.path for package in packages2}
+    common = paths1 & paths2
+    dict1 = {package.path: package for package in packages1}
+    dict2 = {package.path: package for package in packages2}
+    changed = []
+    for path in common:
+        changed.append((dict1.pop(path), dict2.pop(path)))
+    return tuple(sorted(dict2.values())), tuple(sorted(dict1.values())), tuple(sorted(changed))
+
+
+def _best_time(func, repeat):
+    """Call func the given number of times and return its result and the best elapsed time."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def bench_parse(args):
+    """Compare the throughput of the legacy and current Packages parsers."""
+    compare_ppa = load_compare_ppa()
+    data = make_index(args.packages)
+    size = len(data) / (1024 * 1024)
+    print(f'parsing {args.packages} packages ({size:.1f} MiB), best of {args.repeat}')
+    parsers = (
+        ('legacy', lambda: legacy_parse(io.BytesIO(data), None)),
+        ('current', lambda: compare_ppa._parse(io.BytesIO(data), None)),
+        ('current+extra', lambda: list(compare_ppa.parse_index(io.BytesIO(data), ('Source', 'Depends', 'Size')))),
+    )
+    results = {}
+    for name, parse in parsers:
+        results[name], elapsed = _best_time(parse, args.repeat)
+        print(f'{name:>14}: {elapsed:7.3f}s {size / elapsed:7.1f} MiB/s {args.packages / elapsed:10.0f} packages/s')
+    if results['legacy'] != set(results['current']):
+        raise SystemExit('error: parsers returned different results')
+
+
+def bench_memory(args):
+    """Compare the peak memory used by the legacy and current implementations for parsing and comparing."""
+    print(
+        f'parsing and comparing two PPAs with {args.packages} packages '
+        f'for each of {len(args.arches)} architectures')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = [], []
+        for arch in args.arches:
+            for num, salt in enumerate(('', 'changed')):
+                path = os.path.join(tmpdir, f'Packages-{num}-{arch}')
+                with open(path, 'wb') as file:
+                    file.write(make_index(args.packages, arch=arch, salt=salt, salt_every=10))
+                paths[num].append(path)
+        results = {}
+        for implementation in ('baseline', 'legacy', 'current'):
+            out = subprocess.check_output([
+                sys.executable, os.path.abspath(__file__), 'memory-run', implementation,
+                '--source', *paths[0], '--target', *paths[1]])
+            results[implementation] = int(out)
+    for implementation in ('legacy', 'current'):
+        rss = results[implementation] / 1024
+        delta = (results[implementation] - results['baseline']) / 1024
+        print(f'{implementation:>8}: peak RSS {rss:7.1f} MiB ({delta:+7.1f} MiB over baseline)')
+
+
+def bench_memory_run(args):
+    """Parse and compare packages with the given implementation, then print the peak RSS in KiB."""
+    compare_ppa = load_compare_ppa()
+    if args.implementation == 'legacy':
+        parse, compare = legacy_parse, legacy_compare
+    else:
+        parse, compare = compare_ppa._parse, compare_ppa.compare
+    if args.implementation != 'baseline':
+        tables = []
+        for paths in (args.source, args.target):
+            table = parse(io.BytesIO(b''), None)
+            for path in paths:
+                with open(path, 'rb') as file:
+                    table.update(parse(file, None))
+            tables.append(table)
+        compare(*tables)
+    print(_peak_rss())
+
+
+def make_archive(root, suites, components, arches, num_packages, compression='gz', release=True, salt=''):
+    """Write a synthetic PPA tree under the given root directory.
+
+    Each suite, component and architecture has a Packages index with the
+    given number of packages, compressed with the given compression. If
+    release is True, each suite also has InRelease and Release files listing
+    its indexes, as Launchpad PPAs do (the InRelease file is not signed).
+    The given salt is used to change the checksum of one package out of ten.
+    """
+    extension, compress = _COMPRESSORS[compression]
+    for suite in suites:
+        suite_dir = os.path.join(root, 'dists', suite)
+        sums = []
+        for component in components:
+            for arch in arches:
+                index = make_index(num_packages, arch=arch, version=f'1.0~{suite}', salt=salt, salt_every=10)
+                data = compress(index)
+                path = f'{component}/binary-{arch}/Packages{extension}'
+                os.makedirs(os.path.join(suite_dir, os.path.dirname(path)), exist_ok=True)
+                with open(os.path.join(suite_dir, path), 'wb') as file:
+                    file.write(data)
+                sums.append(f' {hashlib.sha256(data).hexdigest()} {len(data):>16} {path}')
+        if release:
+            content = (
+                f'Origin: LP-PPA-benchmark\n'
+                f'Suite: {suite}\n'
+                f'Components: {" ".join(components)}\n'
+                f'Architectures: {" ".join(arches)}\n'
+                f'SHA256:\n' + '\n'.join(sums) + '\n')
+            for name in ('InRelease', 'Release'):
+                with open(os.path.join(suite_dir, name), 'w') as file:
+                    file.write(content)
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """Serve files and directory listings without logging requests."""
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def serve(directory):
+    """Serve the given directory over HTTP on a local port, and yield its base URL."""
+    handler = functools.partial(_QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}/'
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def bench_archive(args):
+    """Time discovery, download, parse and diff of two synthetic PPAs served locally."""
+    compare_ppa = load_compare_ppa()
+    if args.discovery == compare_ppa._DISCOVERY_HTML and args.compression != 'gz':
+        # Only gzipped indexes are looked up when scraping directory listings.
+        raise SystemExit('error: html discovery requires gz compression')
+    num_indexes = len(args.suites) * len(args.components) * len(args.arches)
+    print(
+        f'comparing two PPAs with {num_indexes} {args.compression} indexes of {args.packages} packages each, '
+        f'{args.discovery} discovery, {args.jobs} jobs, best of {args.repeat}')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        for name, salt in (('source', ''), ('target', 'changed')):
+            make_archive(
+                os.path.join(tmpdir, name), args.suites, args.components, args.arches, args.packages,
+                compression=args.compression, release=args.discovery == compare_ppa._DISCOVERY_RELEASE, salt=salt)
+        print(f'archive generated in {time.perf_counter() - start:.1f}s')
+        with serve(tmpdir) as base_url, compare_ppa.Client(pool_size=args.jobs) as client, \
+                futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            urls = [base_url + 'source/', base_url + 'target/']
+            phases = _archive_phases(compare_ppa, client, executor, urls, args)
+            results = {}
+            for name, func in phases:
+                results[name], elapsed = _best_time(func, args.repeat)
+                print(f'{name:>10}: {elapsed:7.3f}s{_throughput(name, results, elapsed, args)}')
+            if args.trace:
+                # Tracing slows down allocations noticeably, so phases are
+                # run again rather than traced while being timed.
+                print('tracing memory allocations')
+                tracemalloc.start()
+                for name, func in phases:
+                    tracemalloc.reset_peak()
+                    current = tracemalloc.get_traced_memory()[0]
+                    func()
+                    peak = (tracemalloc.get_traced_memory()[1] - current) / (1024 * 1024)
+                    print(f'{name:>10}: peak traced {peak:7.1f} MiB')
+                tracemalloc.stop()
+    print(f'peak RSS: {_peak_rss() / 1024:.1f} MiB')
+    num_changes = sum(len(changes) for changes in results['diff'][2:])
+    print(f'{num_changes} changes found')
+
+
+def _archive_phases(compare_ppa, client, executor, urls, args):
+    """Return a list of (name, func) tuples for each phase of comparing the PPAs at the given URLs.
+
+    Each phase uses the results of the previous ones, computed in advance, so
+    that phases can be timed separately.
+    """
+    if args.discovery == compare_ppa._DISCOVERY_RELEASE:
+        discover = compare_ppa._discover_release
+    else:
+        discover = compare_ppa._discover_html
+
+    def discovery():
+        return discover(client, executor, urls, args.suites, args.components, None)
+
+    indexes = [index for url_indexes in discovery() for index in url_indexes]
+
+    def download():
+        return list(executor.map(lambda index: client.get(index.url).content, indexes))
+
+    contents = download()
+
+    def parse():
+        tables = [compare_ppa.PackageTable() for _ in urls]
+        for index, content in zip(indexes, contents):
+            extension = index.url.rpartition('/')[2].partition('.')[2]
+            table = tables[0] if index.url.startswith(urls[0]) else tables[1]
+            table.update(compare_ppa._parse(compare_ppa._DECOMPRESSORS[extension](io.BytesIO(content)), None))
+        return tables
+
+    tables = parse()
+
+    def diff():
+        return compare_ppa.compare(*tables)
+
+    def total():
+        tables = compare_ppa.get_all_packages(
+            urls, suites=args.suites, executor=executor, client=client, components=args.components,
+            discovery=args.discovery)
+        return compare_ppa.compare(*tables)
+
+    return [('discovery', discovery), ('download', download), ('parse', parse), ('diff', diff), ('total', total)]
+
+
+def _throughput(name, results, elapsed, args):
+    """Return a description of the throughput of the given phase, or an empty string."""
+    if name == 'download':
+        size = sum(len(content) for content in results[name]) / (1024 * 1024)
+        return f' {size / elapsed:8.1f} MiB/s ({size:.1f} MiB)'
+    if name in ('parse', 'diff'):
+        num_packages = 2 * len(args.suites) * len(args.components) * len(args.arches) * args.packages
+        return f' {num_packages / elapsed:10.0f} packages/s'
+    return ''
+
+
+def _peak_rss():
+    """Return the peak resident set size of the current process in KiB.
+
+    On Linux the value is read from /proc, as ru_maxrss also accounts for the
+    memory used by the parent before the process was executed.
+    """
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _setup():
+    """Set up the argument parser."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    parse_parser = subparsers.add_parser('parse', help=bench_parse.__doc__)
+    parse_parser.add_argument(
+        '--packages', type=int, default=_DEFAULT_PACKAGES,
+        help=f'How many packages are included in the index (defaulting to {_DEFAULT_PACKAGES})')
+    parse_parser.add_argument(
+        '--repeat', type=int, default=_DEFAULT_REPEAT,
+        help=f'How many times the benchmark is repeated (defaulting to {_DEFAULT_REPEAT})')
+    parse_parser.set_defaults(run=bench_parse)
+    memory_parser = subparsers.add_parser('memory', help=bench_memory.__doc__)
+    memory_parser.add_argument(
+        '--packages', type=int, default=_DEFAULT_PACKAGES,
+        help=f'How many packages are included in each index (defaulting to {_DEFAULT_PACKAGES})')
+    memory_parser.add_argument(
+        '--arches', nargs='+', default=_DEFAULT_ARCHES,
+        help='A space separated list of architectures, each one with its own index')
+    memory_parser.set_defaults(run=bench_memory)
+    archive_parser = subparsers.add_parser('archive', help=bench_archive.__doc__)
+    archive_parser.add_argument(
+        '--packages', type=int, default=_DEFAULT_ARCHIVE_PACKAGES,
+        help=f'How many packages are included in each index (defaulting to {_DEFAULT_ARCHIVE_PACKAGES})')
+    archive_parser.add_argument(
+        '--suites', nargs='+', default=_DEFAULT_ARCHIVE_SUITES,
+        help='A space separated list of suites included in each PPA')
+    archive_parser.add_argument(
+        '--components', nargs='+', default=_DEFAULT_ARCHIVE_COMPONENTS,
+        help='A space separated list of components included in each suite')
+    archive_parser.add_argument(
+        '--arches', nargs='+', default=_DEFAULT_ARCHES,
+        help='A space separated list of architectures, each one with its own index')
+    archive_parser.add_argument(
+        '--compression', choices=sorted(_COMPRESSORS), default='gz',
+        help='How package indexes are compressed (defaulting to gz)')
+    archive_parser.add_argument(
+        '--discovery', choices=('release', 'html'), default='release',
+        help='Whether PPAs include Release files or are discovered through directory listings')
+    archive_parser.add_argument(
+        '-j', '--jobs', type=int, default=8, help='How many concurrent requests are made (defaulting to 8)')
+    archive_parser.add_argument(
+        '--repeat', type=int, default=_DEFAULT_REPEAT,
+        help=f'How many times each phase is repeated (defaulting to {_DEFAULT_REPEAT})')
+    archive_parser.add_argument(
+        '--no-trace', dest='trace', action='store_false',
+        help='Do not trace the memory allocated by each phase, which is slow on large archives')
+    archive_parser.set_defaults(run=bench_archive)
+    # This benchmark is run in a separate process by the memory benchmark.
+    memory_run_parser = subparsers.add_parser('memory-run')
+    memory_run_parser.add_argument('implementation', choices=('baseline', 'legacy', 'current'))
+    memory_run_parser.add_argument('--source', nargs='+', required=True)
+    memory_run_parser.add_argument('--target', nargs='+', required=True)
+    memory_run_parser.set_defaults(run=bench_memory_run)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _setup()
+    args.run(args)
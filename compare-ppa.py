@@ -5,22 +5,84 @@
 # This script requires python3 and the requests package to be installed.
 
 import argparse
+from array import array
 from collections import namedtuple
+from concurrent import futures
+import csv
+import datetime
+import functools
 import gzip
+import hashlib
 from html import parser as html_parser
+import json
 import logging
+import lzma
+import os
+import re
+import sys
+import tempfile
+import threading
 
 import requests
+from requests import adapters
+from urllib3.util import retry
+
+import callstats
 
 
 Package = namedtuple('Package', 'name path version arch sha')
+# Keys used to look up package index fields stored in Package objects, in the
+# same order.
+_PACKAGE_KEYS = (b'\nPackage:', b'\nFilename:', b'\nVersion:', b'\nArchitecture:', b'\nSHA256:')
+# The size in bytes of SHA256 checksums.
+_SHA_SIZE = 32
+# Index is a package index, with its expected SHA256 checksum if known.
+Index = namedtuple('Index', 'url sha')
 Diff = namedtuple('Diff', 'num_source num_target added removed changed')
+# Kinds of changes between packages.
+_ADDED, _REMOVED, _CHANGED = 'added', 'removed', 'changed'
+# Supported output formats.
+_FORMAT_TEXT, _FORMAT_JSON, _FORMAT_JSONL, _FORMAT_CSV = 'text', 'json', 'jsonl', 'csv'
+# MatrixRow holds the packages with the given path in each compared table, or
+# None where the package is missing.
+MatrixRow = namedtuple('MatrixRow', 'path packages')
 _DEFAULT_SUITES = [
     'precise',
     'trusty', 'trusty-infra-security', 'trusty-infra-updates',
     'xenial', 'xenial-infra-security', 'xenial-infra-updates',
     'bionic', 'bionic-infra-security', 'bionic-infra-updates',
 ]
+_DEFAULT_COMPONENTS = ['main']
+# Supported package index discovery modes.
+_DISCOVERY_AUTO, _DISCOVERY_RELEASE, _DISCOVERY_HTML = 'auto', 'release', 'html'
+# Map package index file extensions to the functions used to uncompress them.
+_DECOMPRESSORS = {
+    '': lambda fileobj: fileobj,
+    'gz': lambda fileobj: gzip.GzipFile(mode='r', fileobj=fileobj),
+    'xz': lambda fileobj: lzma.LZMAFile(fileobj, mode='r'),
+}
+# The size in bytes of the chunks read when parsing package indexes.
+_CHUNK_SIZE = 1024 * 1024
+# How many concurrent requests are made by default.
+_DEFAULT_JOBS = 8
+# How many times a failed request is retried, and the backoff factor in seconds
+# used to compute the delay between retries (0.5s, 1s, 2s, 4s...).
+_RETRIES = 5
+_RETRY_BACKOFF = 0.5
+# HTTP status codes considered transient, for which requests are retried.
+_RETRY_STATUSES = (500, 502, 503, 504)
+# Connect and read timeouts for requests, in seconds.
+_TIMEOUT = (10, 60)
+# The default location and maximum size in MiB of the package indexes cache.
+_DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'compare-ppa')
+_DEFAULT_CACHE_SIZE = 256
+# The version of the cache entries format: entries with a different version
+# are ignored.
+_CACHE_VERSION = 3
+# The version of the snapshot files format, and the snapshot files extension.
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_EXTENSION = '.ppa.gz'
 
 
 class _HTMLParser(html_parser.HTMLParser):
@@ -36,89 +98,742 @@ class _HTMLParser(html_parser.HTMLParser):
                 self.links.add(link)
 
 
-def _get_links(url):
+class Client:
+    """An HTTP client reusing pooled keep-alive connections to the archive hosts.
+
+    Requests failing because of connection errors or transient server errors
+    are retried with an exponential backoff.
+    """
+
+    def __init__(self, pool_size=_DEFAULT_JOBS, retries=_RETRIES):
+        self.session = requests.Session()
+        adapter = adapters.HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry.Retry(
+                total=retries,
+                backoff_factor=_RETRY_BACKOFF,
+                status_forcelist=_RETRY_STATUSES,
+                allowed_methods=('GET', 'HEAD'),
+                raise_on_status=False,
+            ))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, allow_missing=False, **kwargs):
+        """Send a GET request to the given URL and return the response.
+
+        Raise a requests.HTTPError if the request still fails after retrying.
+        If allow_missing is True, return None if the resource is not found,
+        without recording the request as failed.
+        """
+        name = url.rpartition('/')[2] or 'listing'
+        with callstats.timed(f'GET {name}', url):
+            resp = self.session.get(url, timeout=_TIMEOUT, **kwargs)
+            if allow_missing and resp.status_code == 404:
+                resp.close()
+                return None
+            resp.raise_for_status()
+        return resp
+
+    def close(self):
+        """Close all pooled connections."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _get_links(client, url):
     """Return href links included in the HTML document at the given URL."""
-    resp = requests.get(url)
-    resp.raise_for_status()
+    resp = client.get(url)
     parser = _HTMLParser()
     parser.feed(resp.text)
     return parser.links
 
 
-def get_packages(url, arches=None, suites=None):
-    """Return a set of all binary packages in the PPA at the given URL.
+def get_packages(url, arches=None, suites=None, executor=None, client=None, cache=None, **kwargs):
+    """Return a PackageTable with all binary packages in the PPA at the given URL.
 
     If an arches sequence is provided, it is used to filter by architecture.
     If a suites sequence is provided, it is used to filter by suite.
+    If an executor is provided, it is used to fetch resources concurrently.
+    If a client is provided, it is used to send HTTP requests.
+    If a cache is provided, it is used to avoid fetching and parsing package
+    indexes that did not change.
+    See get_all_packages for the other supported keyword arguments.
+    """
+    return get_all_packages(
+        [url], arches=arches, suites=suites, executor=executor, client=client, cache=cache, **kwargs)[0]
+
+
+def get_all_packages(
+        urls, arches=None, suites=None, executor=None, client=None, cache=None,
+        components=_DEFAULT_COMPONENTS, discovery=_DISCOVERY_AUTO):
+    """Return a list of PackageTables with all binary packages in the PPAs at the given URLs.
+
+    Package indexes are discovered according to the given discovery mode:
+    - "release" reads the InRelease file of each suite, or the Release file
+      for PPAs not providing any InRelease file;
+    - "html" scrapes the directory listings of suites and architectures;
+    - "auto" reads InRelease files, falling back to scraping directory
+      listings for PPAs not providing any InRelease file.
+    Each discovery stage submits all its requests for all PPAs to the given
+    executor, or runs them serially if no executor is provided, and so does
+    the stage fetching package indexes. Results are the same regardless of the
+    executor being used.
+    All requests are sent using the given client, or a new one if no client is
+    provided. Package indexes are revalidated against the given cache if any.
     """
     if suites is None:
         suites = _DEFAULT_SUITES
-    packages = set()
-    dists_url = url + 'dists/'
-    logging.debug(f'fetching packages: {dists_url}')
-    dist_links = _get_links(dists_url)
-    for dist_link in dist_links:
-        if dist_link.rstrip('/') in suites:
-            dist_url = dists_url + dist_link + 'main/'
-            logging.debug(f'fetching packages: {dist_url}')
-            arch_links = _get_links(dist_url)
-            for arch_link in arch_links:
-                if arch_link.startswith('binary'):
-                    arch_packages = _extract(dist_url + arch_link + 'Packages.gz', arches)
-                    packages.update(arch_packages)
+    if executor is None:
+        executor = _SerialExecutor()
+    if client is None:
+        with Client() as client:
+            return get_all_packages(
+                urls, arches=arches, suites=suites, executor=executor, client=client, cache=cache,
+                components=components, discovery=discovery)
+    indexes = [[] for _ in urls]
+    html_nums = range(len(urls))
+    if discovery != _DISCOVERY_HTML:
+        html_nums = []
+        release_indexes = _discover_release(
+            client, executor, urls, suites, components, arches, fallback=discovery == _DISCOVERY_RELEASE)
+        for num, url_indexes in enumerate(release_indexes):
+            if url_indexes is None:
+                if discovery == _DISCOVERY_AUTO:
+                    logging.debug(f'no release files found, falling back to directory listings: {urls[num]}')
+                    html_nums.append(num)
+                    continue
+                logging.warning(f'no release files found: {urls[num]}')
+            indexes[num] = url_indexes or []
+    html_urls = [urls[num] for num in html_nums]
+    for num, url_indexes in zip(html_nums, _discover_html(client, executor, html_urls, suites, components, arches)):
+        indexes[num] = url_indexes
+    packages = [PackageTable() for _ in urls]
+    all_indexes = [(num, index) for num, url_indexes in enumerate(indexes) for index in url_indexes]
+    extract = functools.partial(_extract, client, arches=arches, cache=cache)
+    index_packages = executor.map(extract, [index for _, index in all_indexes])
+    for (num, _), extracted in zip(all_indexes, index_packages):
+        packages[num].update(extracted)
     return packages
 
 
-def _extract(url, arches):
-    """Uncompress the Packages.gz resource at the given URL and extract included packages."""
+def _discover_html(client, executor, urls, suites, components, arches):
+    """Discover package indexes by scraping directory listings of the PPAs at the given URLs.
+
+    Return a list of Index sequences, one for each URL.
+    """
+    get_links = functools.partial(_get_links, client)
+    dists_urls = [url + 'dists/' for url in urls]
+    for dists_url in dists_urls:
+        logging.debug(f'fetching packages: {dists_url}')
+    dist_urls = []
+    for num, (dists_url, dist_links) in enumerate(zip(dists_urls, executor.map(get_links, dists_urls))):
+        for dist_link in sorted(dist_links):
+            if dist_link.rstrip('/') in suites:
+                for component in components:
+                    dist_urls.append((num, dists_url + dist_link + component + '/'))
+    for _, dist_url in dist_urls:
+        logging.debug(f'fetching packages: {dist_url}')
+    indexes = [[] for _ in urls]
+    arch_links = executor.map(get_links, [dist_url for _, dist_url in dist_urls])
+    for (num, dist_url), links in zip(dist_urls, arch_links):
+        for arch_link in sorted(links):
+            if arch_link.startswith('binary-') and _wants_arch(arch_link[7:].rstrip('/'), arches):
+                indexes[num].append(Index(dist_url + arch_link + 'Packages.gz', None))
+    return indexes
+
+
+def _discover_release(client, executor, urls, suites, components, arches, fallback=True):
+    """Discover package indexes by reading Release files of the PPAs at the given URLs.
+
+    The InRelease file of each suite is looked up first, so that each suite
+    missing from a PPA costs a single request. If fallback is True, Release
+    files are then looked up, only for the PPAs where no InRelease file was
+    found. Return a list of Index sequences, one for each URL, or None for
+    URLs where no Release file could be found.
+    """
+    indexes = [None for _ in urls]
+    nums = range(len(urls))
+    for name in ('InRelease', 'Release'):
+        dist_urls = [(num, urls[num] + 'dists/' + suite + '/') for num in nums for suite in suites]
+        get_indexes = functools.partial(_get_release_indexes, client, name=name, components=components, arches=arches)
+        for (num, _), dist_indexes in zip(dist_urls, executor.map(get_indexes, [url for _, url in dist_urls])):
+            if dist_indexes is not None:
+                indexes[num] = (indexes[num] or []) + dist_indexes
+        if not fallback:
+            break
+        nums = [num for num in nums if indexes[num] is None]
+    return indexes
+
+
+def _get_release_indexes(client, url, name, components, arches):
+    """Return the package indexes listed in the Release file with the given name at the given suite URL.
+
+    When an index is available with different compressions, the smallest
+    supported one is selected. Return None if the suite has no such file.
+    """
+    logging.debug(f'fetching release: {url}{name}')
+    resp = client.get(url + name, allow_missing=True)
+    if resp is None:
+        return None
+    release = _parse_release(resp.text)
+    wanted_components = set(components) & set(release.get('Components', '').split())
+    wanted_arches = {arch for arch in release.get('Architectures', '').split() if _wants_arch(arch, arches)}
+    candidates = {}
+    for line in release.get('SHA256', '').splitlines():
+        fields = line.split()
+        if len(fields) != 3:
+            continue
+        sha, size, path = fields
+        directory, _, filename = path.rpartition('/')
+        base, _, extension = filename.partition('.')
+        component, _, arch_dir = directory.partition('/')
+        if (base != 'Packages' or extension not in _DECOMPRESSORS or component not in wanted_components or
+                arch_dir[7:] not in wanted_arches or not arch_dir.startswith('binary-')):
+            continue
+        candidate = candidates.get(directory)
+        if candidate is None or _index_preference(extension, int(size)) < candidate[0]:
+            candidates[directory] = (_index_preference(extension, int(size)), Index(url + path, sha))
+    return [index for _, index in sorted(candidates.values())]
+
+
+def _index_preference(extension, size):
+    """Return a sort key for choosing between differently compressed indexes.
+
+    Compressed indexes are always preferred, the smallest first.
+    """
+    return (extension == '', size)
+
+
+def _parse_release(text):
+    """Parse the given Release or InRelease file content and return a dict of its fields.
+
+    Multiline field values are returned joined by newlines, without the
+    leading whitespace of continuation lines.
+    """
+    lines = text.splitlines()
+    if lines and lines[0] == '-----BEGIN PGP SIGNED MESSAGE-----':
+        # Strip the armor headers and signature from the clearsigned file.
+        start = lines.index('') + 1
+        end = lines.index('-----BEGIN PGP SIGNATURE-----')
+        lines = [line[2:] if line.startswith('- ') else line for line in lines[start:end]]
+    fields = {}
+    key = None
+    for line in lines:
+        if line[:1] in (' ', '\t'):
+            if key is not None:
+                fields[key] = (fields[key] + '\n' + line.strip()).lstrip('\n')
+            continue
+        key, sep, value = line.partition(':')
+        if not sep:
+            key = None
+            continue
+        fields[key] = value.strip()
+    return fields
+
+
+def _wants_arch(arch, arches):
+    """Report whether an index for the given architecture may include packages for the given arches.
+
+    Indexes for all architectures may include architecture independent
+    packages.
+    """
+    return arches is None or 'all' in arches or arch in arches
+
+
+class _SerialExecutor(futures.Executor):
+    """An executor running submitted calls immediately in the current thread."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as err:
+            future.set_exception(err)
+        return future
+
+
+class Cache:
+    """An on-disk cache of parsed package indexes, keyed by URL.
+
+    Each entry stores the packages parsed from an index along with the ETag and
+    Last-Modified validators sent by the server, so that the index can be
+    revalidated with a conditional request. When the cache grows bigger than
+    the given max size in bytes, least recently used entries are evicted.
+    """
+
+    def __init__(self, path=_DEFAULT_CACHE_DIR, max_size=_DEFAULT_CACHE_SIZE * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _entry_path(self, url):
+        key = hashlib.sha256(url.encode('utf8')).hexdigest()
+        return os.path.join(self.path, key + '.gz')
+
+    def header(self, url):
+        """Return the header of the entry for the given URL, or None if the URL is not cached.
+
+        The header is a dict including the "etag", "last-modified" and "sha"
+        (the SHA256 checksum of the index) keys, whose values may be None.
+        """
+        return self._read(url, header_only=True)
+
+    def get(self, url):
+        """Return the PackageTable cached for the given URL, or None."""
+        return self._read(url)
+
+    def set(self, url, packages, etag=None, last_modified=None, sha=None):
+        """Store the packages parsed from the given URL with its validators."""
+        if not (etag or last_modified or sha):
+            # The resource cannot be revalidated, so it is not worth caching.
+            return
+        header = {
+            'version': _CACHE_VERSION,
+            'url': url,
+            'etag': etag,
+            'last-modified': last_modified,
+            'sha': sha,
+        }
+        _write_packages(self._entry_path(url), header, packages)
+        self._evict()
+
+    def _read(self, url, header_only=False):
+        path = self._entry_path(url)
+        try:
+            header, packages = _read_packages(path, header_only=header_only)
+        except (OSError, ValueError) as err:
+            if not isinstance(err, FileNotFoundError):
+                logging.debug(f'ignoring invalid cache entry for {url}: {err}')
+            return None
+        if header.get('version') != _CACHE_VERSION or header.get('url') != url:
+            return None
+        if header_only:
+            return header
+        # Mark the entry as recently used, unless it has just been evicted.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return packages
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits its max size."""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.gz'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            size = sum(entry_size for _, entry_size, _ in entries)
+            for _, entry_size, path in sorted(entries):
+                if size <= self.max_size:
+                    break
+                logging.debug(f'evicting cache entry: {path}')
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= entry_size
+
+
+def _write_packages(path, header, packages):
+    """Atomically write the given header dict and packages to a compressed file at the given path.
+
+    The header is stored as JSON in the first line, followed by one package per
+    line with tab separated fields.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with gzip.open(os.fdopen(fd, 'wb'), 'wt', encoding='utf8') as file:
+            file.write(json.dumps(header) + '\n')
+            for package in packages:
+                file.write('\t'.join(package) + '\n')
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_packages(path, header_only=False):
+    """Return the header dict and the PackageTable stored in the file at the given path.
+
+    If header_only is True, packages are not read and None is returned instead.
+    Raise an OSError or a ValueError if the file cannot be read.
+    """
+    with gzip.open(path, 'rt', encoding='utf8') as file:
+        header = json.loads(file.readline())
+        if header_only:
+            return header, None
+        packages = PackageTable(Package(*line.rstrip('\n').split('\t')) for line in file)
+    return header, packages
+
+
+def save_snapshot(path, url, packages, **info):
+    """Save a snapshot of the packages fetched from the PPA at the given URL to the given path.
+
+    Additional info about how packages were fetched (e.g. arches or suites)
+    are stored in the snapshot header.
+    """
+    header = {
+        'version': _SNAPSHOT_VERSION,
+        'url': url,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+    }
+    header.update(info)
+    _write_packages(path, header, packages)
+
+
+def load_snapshot(path):
+    """Return the header dict and the PackageTable stored in the snapshot at the given path.
+
+    Raise a ValueError if the file is not a valid snapshot.
+    """
+    try:
+        header, packages = _read_packages(path)
+    except OSError as err:
+        raise ValueError(f'cannot read snapshot {path}: {err}')
+    if header.get('version') != _SNAPSHOT_VERSION:
+        raise ValueError(f'unsupported snapshot {path}')
+    return header, packages
+
+
+def snapshot_name(url):
+    """Return the file name of the snapshot for the PPA at the given URL."""
+    name = re.sub(r'[^\w.-]+', '-', url.partition('://')[2]).strip('-')
+    return name + _SNAPSHOT_EXTENSION
+
+
+def _extract(client, index, arches, cache=None):
+    """Uncompress the given package index and extract included packages.
+
+    If a cache is provided, the index is only fetched and parsed if it changed
+    since it was last cached, either according to its SHA256 checksum in the
+    Release file or by revalidating it with the server.
+    """
+    url = index.url
     logging.debug(f'extracting: {url}')
-    resp = requests.get(url, stream=True)
-    resp.raise_for_status()
-    packages = set()
-    file = gzip.GzipFile(mode='r', fileobj=resp.raw)
-    name = path = version = arch = sha = ''
-    for line in file:
-        line = line.decode('utf8').strip()
-        if line.startswith('Package: '):
-            name = line.split()[1]
-        if line.startswith('Filename: '):
-            path = line.split()[1]
-        if line.startswith('Version: '):
-            version = line.split()[1]
-        if line.startswith('Architecture: '):
-            arch = line.split()[1]
-        if line.startswith('SHA256: '):
-            sha = line.split()[1]
-        if not line:
-            if (arches is None) or (arch in arches):
-                packages.add(Package(name, path, version, arch, sha))
-            name = path = version = arch = sha = ''
+    header = cache.header(url) if cache is not None else None
+    packages = None
+    headers = {}
+    if header is not None:
+        if index.sha and index.sha == header['sha']:
+            logging.debug(f'checksum not changed: {url}')
+            packages = cache.get(url)
+        if header['etag']:
+            headers['If-None-Match'] = header['etag']
+        if header['last-modified']:
+            headers['If-Modified-Since'] = header['last-modified']
+    if packages is None:
+        packages = _fetch(client, index, cache, headers)
+    if arches is None:
+        return packages
+    return packages.filter(arches)
+
+
+def _fetch(client, index, cache, headers):
+    """Fetch and parse the given package index, storing packages in the given cache if any.
+
+    The provided request headers are used for revalidating the cached index.
+    """
+    url = index.url
+    with client.get(url, stream=True, headers=headers) as resp:
+        if resp.status_code == 304:
+            logging.debug(f'not modified: {url}')
+            packages = cache.get(url)
+            if packages is not None:
+                return packages
+            # The cache entry was evicted in the meanwhile.
+            return _fetch(client, index, cache, {})
+        extension = url.rpartition('/')[2].partition('.')[2]
+        packages = _parse(_DECOMPRESSORS[extension](resp.raw), None)
+        if cache is not None:
+            cache.set(
+                url, packages,
+                etag=resp.headers.get('ETag'), last_modified=resp.headers.get('Last-Modified'), sha=index.sha)
     return packages
 
 
+def _parse(file, arches):
+    """Return a PackageTable with packages in the given uncompressed Packages file object."""
+    packages = PackageTable()
+    for package, _ in parse_index(file):
+        if (arches is None) or (package.arch in arches):
+            packages.add(package)
+    return packages
+
+
+def parse_index(file, extra_fields=(), chunk_size=_CHUNK_SIZE):
+    """Generate (package, extra) tuples for each stanza in the given uncompressed Packages file object.
+
+    The file is read in chunks of bytes, and only the fields included in
+    Package objects and the given extra fields (e.g. "Source", "Depends" or
+    "Size") are looked up and decoded. Extra is a dict mapping the extra fields
+    found in the stanza to their values, with continuation lines joined by
+    spaces.
+    """
+    extra_keys = [(field, b'\n' + field.encode('utf8') + b':') for field in extra_fields]
+    for stanza in _stanzas(file, chunk_size):
+        if b':' not in stanza:
+            continue
+        # Prefix the stanza with a newline so that all fields, including the
+        # first one, can be found by looking for a newline followed by the
+        # field name. Continuation lines start with whitespace instead.
+        stanza = b'\n' + stanza
+        values = []
+        for key in _PACKAGE_KEYS:
+            start = stanza.find(key)
+            if start == -1:
+                values.append('')
+                continue
+            start += len(key)
+            end = stanza.find(b'\n', start)
+            values.append(stanza[start:end if end != -1 else None].strip().decode('utf8'))
+        extra = {}
+        for field, key in extra_keys:
+            value = _folded_value(stanza, key)
+            if value is not None:
+                extra[field] = value
+        yield Package(*values), extra
+
+
+def _folded_value(stanza, key):
+    """Return the value of the field with the given key in the stanza, or None if not found.
+
+    Continuation lines are joined by spaces.
+    """
+    start = stanza.find(key)
+    if start == -1:
+        return None
+    start += len(key)
+    end = stanza.find(b'\n', start)
+    while end != -1 and stanza[end + 1:end + 2] in (b' ', b'\t'):
+        end = stanza.find(b'\n', end + 1)
+    return b' '.join(stanza[start:end if end != -1 else None].split()).decode('utf8')
+
+
+def _stanzas(file, chunk_size):
+    """Generate stanzas, as bytes, read in chunks from the given deb822 file object.
+
+    The last stanza is generated even if the file does not end with an empty
+    line.
+    """
+    pending = b''
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        end = pending.rfind(b'\n\n')
+        if end == -1:
+            continue
+        block, pending = pending[:end], pending[end + 2:]
+        yield from block.split(b'\n\n')
+    if pending.strip():
+        yield pending
+
+
+class _StringPool:
+    """A thread safe pool of interned strings, each one identified by an integer reference."""
+
+    def __init__(self):
+        self._refs = {}
+        self._strings = []
+        self._lock = threading.Lock()
+
+    def ref(self, string):
+        """Return the reference to the given string, adding it to the pool if required."""
+        ref = self._refs.get(string)
+        if ref is None:
+            with self._lock:
+                ref = self._refs.get(string)
+                if ref is None:
+                    ref = self._refs[string] = len(self._strings)
+                    self._strings.append(string)
+        return ref
+
+    def __getitem__(self, ref):
+        return self._strings[ref]
+
+
+# The pool of names, versions and architectures shared by all package tables,
+# so that references can be compared across tables.
+_POOL = _StringPool()
+
+
+class PackageTable:
+    """A memory efficient collection of packages, indexed by path.
+
+    Packages are stored in columns: names, versions and architectures are
+    interned in a pool shared by all tables and stored as integer references,
+    and SHA256 checksums are stored as raw bytes. Package objects are only
+    created when packages are retrieved. As with sets, adding a package whose
+    path is already in the table has no effect.
+    """
+    __slots__ = ('_rows', '_names', '_versions', '_arches', '_shas', '_odd_shas')
+
+    def __init__(self, packages=()):
+        # Map paths to row numbers.
+        self._rows = {}
+        self._names = array('L')
+        self._versions = array('L')
+        self._arches = array('L')
+        self._shas = bytearray()
+        # Map row numbers to checksums which are not 32 bytes hex strings.
+        self._odd_shas = {}
+        for package in packages:
+            self.add(package)
+
+    def add(self, package):
+        """Add the given package to the table."""
+        if package.path in self._rows:
+            return
+        row = self._rows[package.path] = len(self._rows)
+        self._names.append(_POOL.ref(package.name))
+        self._versions.append(_POOL.ref(package.version))
+        self._arches.append(_POOL.ref(package.arch))
+        try:
+            sha = bytes.fromhex(package.sha)
+        except ValueError:
+            sha = b''
+        if len(sha) != _SHA_SIZE or sha.hex() != package.sha:
+            self._odd_shas[row] = package.sha
+            sha = bytes(_SHA_SIZE)
+        self._shas += sha
+
+    def update(self, other):
+        """Add all packages in the other table to this table."""
+        for path, row in other._rows.items():
+            self._copy(other, path, row)
+
+    def filter(self, arches):
+        """Return a new table with the packages matching the given architectures."""
+        refs = {_POOL.ref(arch) for arch in arches}
+        table = PackageTable()
+        for path, row in self._rows.items():
+            if self._arches[row] in refs:
+                table._copy(self, path, row)
+        return table
+
+    def _copy(self, other, path, row):
+        """Add the package at the given row of the other table, without retrieving it."""
+        if path in self._rows:
+            return
+        new_row = self._rows[path] = len(self._rows)
+        self._names.append(other._names[row])
+        self._versions.append(other._versions[row])
+        self._arches.append(other._arches[row])
+        self._shas += other._shas[row * _SHA_SIZE:(row + 1) * _SHA_SIZE]
+        if row in other._odd_shas:
+            self._odd_shas[new_row] = other._odd_shas[row]
+
+    def get(self, path):
+        """Return the package with the given path, or None if not found."""
+        row = self._rows.get(path)
+        if row is None:
+            return None
+        return self._package(path, row)
+
+    def _package(self, path, row):
+        sha = self._odd_shas.get(row)
+        if sha is None:
+            sha = self._shas[row * _SHA_SIZE:(row + 1) * _SHA_SIZE].hex()
+        return Package(
+            name=_POOL[self._names[row]],
+            path=path,
+            version=_POOL[self._versions[row]],
+            arch=_POOL[self._arches[row]],
+            sha=sha,
+        )
+
+    def _key(self, row):
+        """Return a key representing the package at the given row, for comparing packages across tables."""
+        sha = self._odd_shas.get(row)
+        if sha is None:
+            sha = self._shas[row * _SHA_SIZE:(row + 1) * _SHA_SIZE]
+        return self._names[row], self._versions[row], self._arches[row], sha
+
+    def paths(self):
+        """Return a view of the package paths, in insertion order."""
+        return self._rows.keys()
+
+    def __contains__(self, path):
+        return path in self._rows
+
+    def __iter__(self):
+        """Generate packages in insertion order."""
+        for path, row in self._rows.items():
+            yield self._package(path, row)
+
+    def __len__(self):
+        return len(self._rows)
+
+
 def compare(packages1, packages2):
-    """Compare two sets of package objects and produce a Diff."""
-    num_source, num_target = len(packages1), len(packages2)
-    common = packages1 & packages2
-    packages1 -= common
-    packages2 -= common
-    paths1 = {package.path for package in packages1}
-    paths2 = {package.path for package in packages2}
-    common = paths1 & paths2
-    dict1 = {package.path: package for package in packages1}
-    dict2 = {package.path: package for package in packages2}
-    changed = []
-    for path in common:
-        changed.append((dict1.pop(path), dict2.pop(path)))
+    """Compare two package tables and produce a Diff."""
+    added, removed, changed = [], [], []
+    for change, package1, package2 in iter_diff(packages1, packages2):
+        if change == _ADDED:
+            added.append(package2)
+        elif change == _REMOVED:
+            removed.append(package1)
+        else:
+            changed.append((package1, package2))
     return Diff(
-        num_source=num_source,
-        num_target=num_target,
-        added=tuple(sorted(dict2.values())),
-        removed=tuple(sorted(dict1.values())),
+        num_source=len(packages1),
+        num_target=len(packages2),
+        added=tuple(sorted(added)),
+        removed=tuple(sorted(removed)),
         changed=tuple(sorted(changed)),
     )
 
 
+def iter_diff(packages1, packages2):
+    """Generate (change, package1, package2) tuples for packages differing in the two tables.
+
+    Change is "removed", "changed" or "added", and the package missing from one
+    of the tables is None. Tuples are generated as differences are found,
+    without any specific ordering.
+    Packages are joined by path on the tables indexes, without copying the
+    tables: only differing packages are retrieved.
+    """
+    rows1, rows2 = packages1._rows, packages2._rows
+    for path, row1 in rows1.items():
+        row2 = rows2.get(path)
+        if row2 is None:
+            yield _REMOVED, packages1._package(path, row1), None
+        elif packages1._key(row1) != packages2._key(row2):
+            yield _CHANGED, packages1._package(path, row1), packages2._package(path, row2)
+    for path, row2 in rows2.items():
+        if path not in rows1:
+            yield _ADDED, None, packages2._package(path, row2)
+
+
+def compare_many(tables):
+    """Compare any number of package tables and return a list of MatrixRows.
+
+    Rows are only returned for packages which are not the same in all tables,
+    sorted by the first package found in each row.
+    """
+    rows = []
+    for num, table in enumerate(tables):
+        for path in table.paths():
+            if any(path in previous for previous in tables[:num]):
+                # The path has been already processed.
+                continue
+            keys = [other._key(other._rows[path]) if path in other else None for other in tables]
+            if None in keys or any(key != keys[0] for key in keys):
+                rows.append(MatrixRow(path=path, packages=tuple(other.get(path) for other in tables)))
+    return sorted(rows, key=lambda row: [package for package in row.packages if package is not None][0])
+
+
 def report(diff):
     """Report information included in the diff."""
     if diff.added:
@@ -142,6 +857,79 @@ def report(diff):
     print(f'source: {diff.num_source} | target: {diff.num_target}')
 
 
+def write_diff(packages1, packages2, output_format, file=None):
+    """Write differences between the two package tables to the given file (stdout by default).
+
+    Supported formats are "json", "jsonl" and "csv". Records are written while
+    differences are found, so that consumers can start processing them before
+    the comparison is completed.
+    """
+    if file is None:
+        file = sys.stdout
+    records = iter_diff(packages1, packages2)
+    if output_format == _FORMAT_CSV:
+        writer = csv.writer(file)
+        writer.writerow(['change', 'path'] + [
+            f'{side}_{field}' for side in ('source', 'target') for field in ('name', 'version', 'arch', 'sha')])
+        for change, package1, package2 in records:
+            path = (package1 or package2).path
+            row = [change, path]
+            for package in (package1, package2):
+                row.extend(('', '', '', '') if package is None else (
+                    package.name, package.version, package.arch, package.sha))
+            writer.writerow(row)
+        return
+    if output_format == _FORMAT_JSON:
+        file.write(f'{{"num_source": {len(packages1)}, "num_target": {len(packages2)}, "changes": [')
+    for num, (change, package1, package2) in enumerate(records):
+        record = json.dumps({
+            'change': change,
+            'path': (package1 or package2).path,
+            'source': _package_record(package1),
+            'target': _package_record(package2),
+        })
+        if output_format == _FORMAT_JSONL:
+            file.write(record + '\n')
+        else:
+            file.write((',\n' if num else '\n') + record)
+    if output_format == _FORMAT_JSON:
+        file.write('\n]}\n')
+
+
+def _package_record(package):
+    """Return a JSON serializable dict representing the given package, or None."""
+    if package is None:
+        return None
+    return {'name': package.name, 'version': package.version, 'arch': package.arch, 'sha': package.sha}
+
+
+def report_matrix(sources, tables, rows):
+    """Report information included in the matrix rows comparing the given sources."""
+    for num, (source, table) in enumerate(zip(sources, tables), 1):
+        print(f'[{num}] {source}: {len(table)}')
+    if rows:
+        print(f'* {len(rows)} different')
+    for row in rows:
+        print(f'* {row.path}')
+        for num, package in enumerate(row.packages, 1):
+            if package is None:
+                print(f'  [{num}] missing')
+                continue
+            print(f'  [{num}] {package.name} {package.version} ({package.arch})')
+            print(f'      {package.sha}')
+
+
+def _source(value):
+    """Validate that the given value is a snapshot file path or a valid URL.
+
+    Return the path as is, or a cleaned up URL as returned by _ppa_url.
+    Raise an ArgumentTypeError if the value is not valid.
+    """
+    if os.path.isfile(value):
+        return value
+    return _ppa_url(value)
+
+
 def _ppa_url(value):
     """Validate that the given value is a valid URL.
 
@@ -159,15 +947,49 @@ def _ppa_url(value):
 def _setup():
     """Set up logging and argument parser."""
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('ppa1', help='URL of the first PPA', type=_ppa_url)
-    parser.add_argument('ppa2', help='URL of the second PPA', type=_ppa_url)
+    parser.add_argument(
+        'ppas', nargs='+', type=_source,
+        help='URLs of the PPAs to compare, or paths of snapshots previously saved with --snapshot-dir.\n'
+             'When more than two are provided, a matrix of differing packages is reported')
+    parser.add_argument(
+        '--matrix', action='store_true', help='Report a matrix of differing packages even when comparing two PPAs')
+    parser.add_argument(
+        '--format', choices=(_FORMAT_TEXT, _FORMAT_JSON, _FORMAT_JSONL, _FORMAT_CSV), default=_FORMAT_TEXT,
+        help='The format used to report differences between two PPAs (defaulting to text).\n'
+             'Machine readable formats are written while differences are found, without ordering')
     parser.add_argument(
         '--arches', nargs='+', help='A space separated list of architectures to retrieve (by default all are fetched)')
     parser.add_argument(
         '--suites', nargs='+',
         help='A space separated list of suites to retrieve if present in the PPA\n(defaulting to all known suites)')
+    parser.add_argument(
+        '--components', nargs='+', default=_DEFAULT_COMPONENTS,
+        help='A space separated list of components to retrieve (defaulting to {})'.format(' '.join(_DEFAULT_COMPONENTS)))
+    parser.add_argument(
+        '--discovery', choices=(_DISCOVERY_AUTO, _DISCOVERY_RELEASE, _DISCOVERY_HTML), default=_DISCOVERY_AUTO,
+        help='How package indexes are discovered: from Release files, from directory listings,\n'
+             'or from Release files falling back to directory listings (the default)')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=_DEFAULT_JOBS,
+        help=f'How many requests to run concurrently (defaulting to {_DEFAULT_JOBS}, 1 to fetch serially)')
+    parser.add_argument(
+        '--cache-dir', default=_DEFAULT_CACHE_DIR,
+        help=f'The directory where package indexes are cached (defaulting to {_DEFAULT_CACHE_DIR})')
+    parser.add_argument(
+        '--cache-size', type=int, default=_DEFAULT_CACHE_SIZE,
+        help=f'The maximum size of the cache in MiB (defaulting to {_DEFAULT_CACHE_SIZE})')
+    parser.add_argument('--no-cache', action='store_true', help='Always fetch and parse package indexes')
+    parser.add_argument('--snapshot-dir', help='A directory where to save snapshots of the fetched PPAs')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
+    callstats.add_arguments(parser)
     args = parser.parse_args()
+    callstats.setup(args)
+    if args.jobs < 1:
+        parser.error('the number of jobs must be a positive integer')
+    if len(args.ppas) < 2 and not args.snapshot_dir:
+        parser.error('at least two PPAs must be provided when not saving snapshots')
+    if args.format != _FORMAT_TEXT and (len(args.ppas) > 2 or args.matrix):
+        parser.error(f'the {args.format} format is only supported when comparing two PPAs')
     logging.basicConfig(
         datefmt='%Y-%m-%d %H:%M:%S',
         format='%(asctime)s %(levelname)s:\t%(message)s',
@@ -177,10 +999,39 @@ def _setup():
 
 def _run(args):
     """Run the command."""
-    packages1 = get_packages(args.ppa1, arches=args.arches, suites=args.suites)
-    packages2 = get_packages(args.ppa2, arches=args.arches, suites=args.suites)
-    diff = compare(packages1, packages2)
-    report(diff)
+    sources = {}
+    urls = []
+    for source in args.ppas:
+        if source in sources or source in urls:
+            continue
+        if os.path.isfile(source):
+            header, packages = load_snapshot(source)
+            logging.debug(f'loaded snapshot of {header["url"]} created at {header["created"]}: {source}')
+            sources[source] = packages if args.arches is None else packages.filter(args.arches)
+        else:
+            urls.append(source)
+    if urls:
+        cache = None if args.no_cache else Cache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+        with Client(pool_size=args.jobs) as client, futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            tables = get_all_packages(
+                urls, arches=args.arches, suites=args.suites, components=args.components,
+                discovery=args.discovery, executor=executor, client=client, cache=cache)
+        sources.update(zip(urls, tables))
+    if args.snapshot_dir:
+        os.makedirs(args.snapshot_dir, exist_ok=True)
+        for url in urls:
+            path = os.path.join(args.snapshot_dir, snapshot_name(url))
+            save_snapshot(
+                path, url, sources[url], arches=args.arches, suites=args.suites, components=args.components)
+            logging.info(f'snapshot of {url} saved: {path}')
+    tables = [sources[source] for source in args.ppas]
+    if len(tables) == 2 and not args.matrix:
+        if args.format == _FORMAT_TEXT:
+            report(compare(*tables))
+        else:
+            write_diff(*tables, args.format)
+    elif len(tables) > 1:
+        report_matrix(args.ppas, tables, compare_many(tables))
 
 
 if __name__ == '__main__':
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import argparse
-import subprocess
+
+import callstats
+import contractlib
 
 
 # Define account related tables.
@@ -14,42 +16,76 @@ ACCOUNT_RELATED_TABLES = (
     "temporary_account_tokens",
 )
 
-
-def run_contract(cmd, *args):
-    """Run the contract CLI with the given subcommnd and args."""
-    command = ("contract", cmd) + tuple(args)
-    return subprocess.check_output(command).decode("utf-8")
+# How many encoded ids to decode concurrently.
+DECODE_JOBS = 8
 
 
 def get_delete_queries(id, delete_users):
     """Return a list of queries to be run to delete an account with the given id."""
+    return _get_delete_queries(f"= {contractlib.quote(id)}", delete_users)
+
+
+def get_bulk_delete_queries(ids, delete_users, batch_size=None):
+    """Return a list of queries to be run to delete accounts with the given ids.
+
+    Each related table is cleaned up with a single query for each batch of at
+    most batch_size ids (or for all ids if batch_size is None), and each batch
+    is deleted in its own transaction.
+    """
+    queries = []
+    for batch in contractlib.batched(ids, batch_size):
+        queries.append("BEGIN;")
+        queries.extend(_get_delete_queries(f"= ANY({contractlib.quote_array(batch)})", delete_users))
+        queries.append("COMMIT;")
+    return queries
+
+
+def _get_delete_queries(match, delete_users):
     queries = [
-        f"DELETE FROM subscriptions_external_subscription_ids WHERE subscription IN (SELECT id FROM subscriptions WHERE account_id = '{id}');",
-        f"DELETE FROM purchase_items WHERE purchase_id IN (SELECT id FROM purchases WHERE account_id = '{id}');",
-        f"DELETE FROM contract_products WHERE contract_id IN (SELECT id FROM contracts WHERE account_id = '{id}');",
-        f"DELETE FROM contract_items WHERE contract_id IN (SELECT id FROM contracts WHERE account_id = '{id}');",
+        f"DELETE FROM subscriptions_external_subscription_ids WHERE subscription IN (SELECT id FROM subscriptions WHERE account_id {match});",
+        f"DELETE FROM purchase_items WHERE purchase_id IN (SELECT id FROM purchases WHERE account_id {match});",
+        f"DELETE FROM contract_products WHERE contract_id IN (SELECT id FROM contracts WHERE account_id {match});",
+        f"DELETE FROM contract_items WHERE contract_id IN (SELECT id FROM contracts WHERE account_id {match});",
     ]
     if delete_users:
-        queries.append(f"DELETE FROM users WHERE id IN (SELECT user_id FROM account_access WHERE account_id = '{id}');")
-    queries.extend(f"DELETE FROM {table} WHERE account_id = '{id}';" for table in ACCOUNT_RELATED_TABLES)
-    queries.append(f"DELETE FROM accounts WHERE id = '{id}';")
+        queries.append(f"DELETE FROM users WHERE id IN (SELECT user_id FROM account_access WHERE account_id {match});")
+    queries.extend(f"DELETE FROM {table} WHERE account_id {match};" for table in ACCOUNT_RELATED_TABLES)
+    queries.append(f"DELETE FROM accounts WHERE id {match};")
     return queries
 
 
 def setup():
     parser = argparse.ArgumentParser()
-    parser.add_argument("id", help="id of the account to delete, either encoded or decoded")
+    parser.add_argument("ids", nargs="+", help="ids of the accounts to delete, either encoded or decoded")
     parser.add_argument("--delete-users", action="store_true", help="whether to generate queries for deleting users")
-    return parser.parse_args()
+    parser.add_argument(
+        "--bulk", action="store_true",
+        help="delete all accounts with a single query per table, inside a transaction")
+    parser.add_argument(
+        "--batch-size", type=int,
+        help="with --bulk, how many accounts to delete in each transaction (all of them by default)")
+    callstats.add_arguments(parser)
+    args = parser.parse_args()
+    callstats.setup(args)
+    if args.batch_size is not None and args.batch_size < 1:
+        parser.error("the batch size must be a positive integer")
+    if args.batch_size is not None and not args.bulk:
+        parser.error("--batch-size requires --bulk")
+    return args
 
 
-def main(account_id, delete_users):
-    if account_id.startswith("a"):
-        account_id = run_contract("decode-id", account_id).strip().strip("'")
-    queries = get_delete_queries(account_id, delete_users)
+def main(account_ids, delete_users, bulk, batch_size):
+    encoded_ids = [id for id in account_ids if id.startswith("a")]
+    if encoded_ids:
+        decoded = dict(zip(encoded_ids, contractlib.decode_many(encoded_ids, jobs=DECODE_JOBS)))
+        account_ids = [decoded.get(id, id) for id in account_ids]
+    if bulk:
+        queries = get_bulk_delete_queries(account_ids, delete_users, batch_size=batch_size)
+    else:
+        queries = [query for id in account_ids for query in get_delete_queries(id, delete_users)]
     print("\n".join(queries))
 
 
 if __name__ == "__main__":
     args = setup()
-    main(args.id, args.delete_users)
+    main(args.ids, args.delete_users, args.bulk, args.batch_size)
@@ -1,50 +1,46 @@
 #!/usr/bin/env python3
 
 import argparse
-import subprocess
 
+import callstats
+import contractlib
 
-# Define contract related tables.
-CONTRACT_RELATED_TABLES = (
-    "contract_tokens",
-    "contract_products",
-    "contract_affordances",
-    "contract_allowances",
-    "contract_directives",
-    "contract_obligations",
-    "contract_external_asset_ids",
-    "contract_machines",
-    "contract_items",
-    "resource_access",
-)
 
-
-def run_contract(cmd, *args):
-    """Run the contract CLI with the given subcommnd and args."""
-    command = ("contract", cmd) + tuple(args)
-    return subprocess.check_output(command).decode("utf-8")
-
-
-def get_delete_queries(id):
-    """Return a list of queries to be run to delete a contract with the given id."""
-    queries = [f"DELETE FROM {table} WHERE contract_id = '{id}';" for table in CONTRACT_RELATED_TABLES]
-    queries.append(f"DELETE FROM contracts WHERE id = '{id}';")
-    return queries
+# How many encoded ids to decode concurrently.
+DECODE_JOBS = 8
 
 
 def setup():
     parser = argparse.ArgumentParser()
-    parser.add_argument("id", help="id of the contract to delete, either encoded or decoded")
-    return parser.parse_args()
-
-
-def main(contract_id):
-    if contract_id.startswith("c"):
-        contract_id = run_contract("decode-id", contract_id).strip().strip("'")
-    queries = get_delete_queries(contract_id)
+    parser.add_argument("ids", nargs="+", help="ids of the contracts to delete, either encoded or decoded")
+    parser.add_argument(
+        "--bulk", action="store_true",
+        help="delete all contracts with a single query per table, inside a transaction")
+    parser.add_argument(
+        "--batch-size", type=int,
+        help="with --bulk, how many contracts to delete in each transaction (all of them by default)")
+    callstats.add_arguments(parser)
+    args = parser.parse_args()
+    callstats.setup(args)
+    if args.batch_size is not None and args.batch_size < 1:
+        parser.error("the batch size must be a positive integer")
+    if args.batch_size is not None and not args.bulk:
+        parser.error("--batch-size requires --bulk")
+    return args
+
+
+def main(contract_ids, bulk, batch_size):
+    encoded_ids = [id for id in contract_ids if id.startswith("c")]
+    if encoded_ids:
+        decoded = dict(zip(encoded_ids, contractlib.decode_many(encoded_ids, jobs=DECODE_JOBS)))
+        contract_ids = [decoded.get(id, id) for id in contract_ids]
+    if bulk:
+        queries = contractlib.get_bulk_delete_contract_queries(contract_ids, batch_size=batch_size)
+    else:
+        queries = [query for id in contract_ids for query in contractlib.get_delete_contract_queries(id)]
     print("\n".join(queries))
 
 
 if __name__ == "__main__":
     args = setup()
-    main(args.id)
+    main(args.ids, args.bulk, args.batch_size)
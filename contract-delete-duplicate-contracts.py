@@ -2,67 +2,136 @@
 
 import argparse
 import collections
+from concurrent import futures
 import datetime
-import json
+import itertools
+import os
 import operator
 import subprocess
 import sys
 
+import callstats
+import contractlib
+import contractsapi
+
 
 # Contract represents a contract in ua-contracts.
 Contract = collections.namedtuple("Contract", "id encoded_id effective_to products account_id account_name")
 
-# Define contract related tables.
-CONTRACT_RELATED_TABLES = (
-    "contract_tokens",
-    "contract_products",
-    "contract_affordances",
-    "contract_allowances",
-    "contract_directives",
-    "contract_obligations",
-    "contract_external_asset_ids",
-    "contract_machines",
-    "contract_items",
-    "resource_access",
-)
+# How many contract lookups to queue for each job.
+LOOKUP_WINDOW = 4
 
-now = datetime.datetime.now()
+# How many contracts to delete in each transaction when streaming with --bulk.
+STREAM_BATCH_SIZE = 1000
 
+# Map report sections to the names of their files when streaming.
+STREAM_SECTIONS = {
+    "failed": "lookup-failed.txt",
+    "not_expiring": "never-expiring.txt",
+    "multiple_effective": "multiple-effective.txt",
+    "keep": "keep.txt",
+    "delete": "delete.txt",
+    "queries": "queries.sql",
+}
 
-def run_contract(cmd, *args):
-    """Run the contract CLI with the given subcommnd and args."""
-    command = ("contract", cmd) + tuple(args)
-    return subprocess.check_output(command).decode("utf-8")
+# Map report sections to their descriptions in the streaming summary.
+STREAM_TITLES = {
+    "failed": "problematic contracts, lookup failed",
+    "not_expiring": "problematic contracts, never expiring",
+    "multiple_effective": "problematic contracts, multiple effective for the same account and product",
+    "keep": "contracts to keep",
+    "delete": "contracts to delete",
+}
 
+QUERIES_HEADER = (
+    "-- Queries are generated by running the script at\n"
+    "-- https://github.com/frankban/yellow-tools/blob/master/contract-delete-duplicate-contracts.py")
+
+now = datetime.datetime.now()
 
-def get_account_contracts(ids):
-    """Return a dictionary mapping account ids to contracts with the given ids."""
+
+def get_account_contracts(ids, checkpoint, jobs=1):
+    """Return a dictionary mapping account ids to contracts with the given ids.
+
+    Contracts are looked up concurrently using the given number of jobs, and
+    grouped in the order of the given ids. Contracts already in the given
+    checkpoint are not looked up again. Also return the list of ids whose
+    lookup failed.
+    """
+    contracts, failed = [None] * len(ids), []
+    for num, id, contract in iter_contracts(ids, checkpoint, jobs=jobs, total=len(ids)):
+        if contract is None:
+            failed.append(num)
+        contracts[num] = contract
     account_contracts = {}
-    ids_len = len(ids)
-    for num, id in enumerate(ids):
-        print(f"{num}/{ids_len}", end="\r", file=sys.stderr)
-        encoded_id = run_contract("encode-id", "c", id).strip()
-        out = run_contract("show-contract", encoded_id, "--format", "json")
-        info = json.loads(out)
-        contract_info, account_info = info["contractInfo"], info["accountInfo"]
-        effective_to = contract_info.get("effectiveTo")
-        if effective_to is not None:
-            try:
-                effective_to = datetime.datetime.strptime(effective_to, "%Y-%m-%dT%H:%M:%S.%f%z")
-            except ValueError:
-                effective_to = datetime.datetime.strptime(effective_to, "%Y-%m-%dT%H:%M:%S%z")
-            effective_to = effective_to.replace(tzinfo=None)
-        contract = Contract(
-            id=id,
-            encoded_id=contract_info["id"],
-            effective_to=effective_to,
-            products=", ".join(sorted(contract_info['products'])),
-            account_id=account_info["id"],
-            account_name=account_info["name"],
-        )
-        key = (contract.account_id, contract.products)
-        account_contracts.setdefault(key, []).append(contract)
-    return account_contracts
+    for contract in contracts:
+        if contract is not None:
+            key = (contract.account_id, contract.products)
+            account_contracts.setdefault(key, []).append(contract)
+    return account_contracts, [ids[num] for num in sorted(failed)]
+
+
+def iter_contracts(ids, checkpoint, jobs=1, total=None):
+    """Generate (num, id, contract) tuples for the given iterable of ids, in completion order.
+
+    Contracts are looked up concurrently using the given number of jobs, with
+    at most LOOKUP_WINDOW lookups per job queued at any time, so that ids are
+    consumed lazily. The num is the position of the id in the input, and the
+    contract is None if its lookup failed.
+    """
+    ids = enumerate(ids)
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        fs = {}
+
+        def submit(count):
+            for num, id in itertools.islice(ids, count):
+                fs[executor.submit(get_contract, id, checkpoint, num)] = num, id
+
+        submit(jobs * LOOKUP_WINDOW)
+        done_count = 0
+        while fs:
+            done, _ = futures.wait(fs, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                num, id = fs.pop(future)
+                done_count += 1
+                progress = done_count if total is None else f"{done_count}/{total}"
+                print(progress, end="\r", file=sys.stderr)
+                try:
+                    contract = future.result()
+                except (subprocess.CalledProcessError, ValueError, LookupError) as err:
+                    print(f"cannot retrieve contract {id}: {err!r}", file=sys.stderr)
+                    contract = None
+                yield num, id, contract
+            submit(len(done))
+
+
+def get_contract(id, checkpoint, num=None):
+    """Return the contract with the given decoded id.
+
+    The contract info is retrieved from the given checkpoint, or looked up and
+    stored there if not present, along with num, the position of the id in the
+    input, so that offline runs process contracts in the same order.
+    """
+    def lookup(id):
+        return contractsapi.default_client().call("show-contract", contractlib.encode_id("c", id))
+
+    info = checkpoint.fetch("contract", id, lookup, num=num)
+    contract_info, account_info = info["contractInfo"], info["accountInfo"]
+    effective_to = contract_info.get("effectiveTo")
+    if effective_to is not None:
+        try:
+            effective_to = datetime.datetime.strptime(effective_to, "%Y-%m-%dT%H:%M:%S.%f%z")
+        except ValueError:
+            effective_to = datetime.datetime.strptime(effective_to, "%Y-%m-%dT%H:%M:%S%z")
+        effective_to = effective_to.replace(tzinfo=None)
+    return Contract(
+        id=id,
+        encoded_id=contract_info["id"],
+        effective_to=effective_to,
+        products=", ".join(sorted(contract_info['products'])),
+        account_id=account_info["id"],
+        account_name=account_info["name"],
+    )
 
 
 def split_contracts(account_contracts):
@@ -81,56 +150,225 @@ def _split_contracts(contracts, to_keep, to_delete, not_expiring, multiple_effec
             continue
         to_process.append(contract)
     to_process = sorted(to_process, key=operator.attrgetter("effective_to"))
-    while len(to_process) > 1:
-        if to_process[0].effective_to >= now:
-            multiple_effective.extend(to_process)
+    for num in range(len(to_process) - 1):
+        if to_process[num].effective_to >= now:
+            multiple_effective.extend(to_process[num:])
+            return
+        to_delete.append(to_process[num])
+    to_keep.extend(to_process[-1:])
+
+
+class ContractGroups:
+    """Split contracts into the same sections as split_contracts, incrementally.
+
+    Contracts are added one at a time, and classified as soon as possible by
+    calling the corresponding method of the given report: not_expiring,
+    multiple_effective, keep or delete. Only the latest expired contract and
+    the effective ones are retained for each account and product, until
+    close is called and the remaining contracts are classified. Contracts are
+    added with their position in the input, used to break ties in the same
+    way split_contracts does, regardless of the order they are added.
+    """
+
+    def __init__(self, report):
+        self.report = report
+        # Map (account id, products) keys to the latest expired contract and
+        # the list of effective contracts, as (effective to, num, contract).
+        self._groups = {}
+
+    def add(self, contract, num):
+        if contract.effective_to is None:
+            self.report.not_expiring(contract)
             return
-        to_delete.append(to_process.pop(0))
-    to_keep.extend(to_process)
+        key = (contract.account_id, contract.products)
+        latest_expired, effective = self._groups.setdefault(key, (None, []))
+        item = (contract.effective_to, num, contract)
+        if contract.effective_to >= now:
+            effective.append(item)
+            return
+        if latest_expired is None:
+            self._groups[key] = item, effective
+        elif item[:2] > latest_expired[:2]:
+            self.report.delete(latest_expired[2])
+            self._groups[key] = item, effective
+        else:
+            self.report.delete(contract)
+
+    def close(self):
+        for latest_expired, effective in self._groups.values():
+            if effective and latest_expired is not None:
+                self.report.delete(latest_expired[2])
+            if len(effective) > 1:
+                for _, _, contract in sorted(effective, key=operator.itemgetter(0, 1)):
+                    self.report.multiple_effective(contract)
+            elif effective:
+                self.report.keep(effective[0][2])
+            else:
+                self.report.keep(latest_expired[2])
+        self._groups = {}
+
 
+class StreamingReport:
+    """Write report sections to separate files in the given directory, as contracts are classified.
 
-def get_delete_queries(id):
-    """Return a list of queries to be run to delete a contract with the given id."""
-    queries = [f"DELETE FROM {table} WHERE contract_id = '{id}';" for table in CONTRACT_RELATED_TABLES]
-    queries.append(f"DELETE FROM contracts WHERE id = '{id}';")
-    return queries
+    Queries are written as contracts to be deleted are found, in batches of
+    batch_size contracts if bulk is True.
+    """
+
+    def __init__(self, directory, bulk=False, batch_size=STREAM_BATCH_SIZE):
+        self.directory = directory
+        self.bulk = bulk
+        self.batch_size = batch_size
+        self.counts = collections.Counter()
+        self._batch = []
+        os.makedirs(directory, exist_ok=True)
+        self._files = {section: open(self.path(section), "w") for section in STREAM_SECTIONS}
+        self._write("queries", QUERIES_HEADER)
+
+    def path(self, section):
+        """Return the path of the file for the given section."""
+        return os.path.join(self.directory, STREAM_SECTIONS[section])
+
+    def _write(self, section, text):
+        self._files[section].write(text + "\n")
+
+    def failed(self, id):
+        self.counts["failed"] += 1
+        self._write("failed", f"- {id}")
+
+    def not_expiring(self, contract):
+        self.counts["not_expiring"] += 1
+        self._write("not_expiring", format_contract(contract, with_effective_to=False))
+
+    def multiple_effective(self, contract):
+        self.counts["multiple_effective"] += 1
+        self._write("multiple_effective", format_contract(contract))
+
+    def keep(self, contract):
+        self.counts["keep"] += 1
+        self._write("keep", format_contract(contract))
+
+    def delete(self, contract):
+        self.counts["delete"] += 1
+        self._write("delete", format_deleted_contract(contract))
+        self._write("queries", "\n" + format_delete_comment(contract))
+        if not self.bulk:
+            self._write("queries", "\n".join(contractlib.get_delete_contract_queries(contract.id)))
+            return
+        self._batch.append(contract.id)
+        if len(self._batch) >= self.batch_size:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        if self._batch:
+            queries = contractlib.get_bulk_delete_contract_queries(self._batch)
+            self._write("queries", "\n" + "\n".join(queries))
+            self._batch = []
+
+    def close(self):
+        self._flush_batch()
+        for file in self._files.values():
+            file.close()
+
+
+def format_contract(contract, with_effective_to=True):
+    """Return a description of the given contract for the report sections."""
+    lines = [f"- {contract.products} {contract.encoded_id}", f"  {contract.id}"]
+    if with_effective_to:
+        lines.append(f"  effective to {contract.effective_to}")
+    lines.append(f"  owned by {contract.account_name} ({contract.account_id})")
+    return "\n".join(lines)
+
+
+def format_deleted_contract(contract):
+    """Return a one line description of the given contract for the contracts to delete section."""
+    return f"{contract.encoded_id}  # {contract.products} owned by {contract.account_name} effective to {contract.effective_to}"
+
+
+def format_delete_comment(contract):
+    """Return an SQL comment describing the given contract to be deleted."""
+    return (
+        f"-- Delete {contract.products} contract {contract.encoded_id}\n"
+        f"-- owned by {contract.account_id} effective to {contract.effective_to}")
 
 
 def setup():
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "file", type=argparse.FileType("r"),
-        help="name of a file containing a list of contract ids separated by newlines")
-    return parser.parse_args()
+        "file", type=argparse.FileType("r"), nargs="?",
+        help="name of a file containing a list of contract ids separated by newlines "
+             "(optional with --offline, in which case all recorded contracts are used)")
+    parser.add_argument("--jobs", type=int, default=1, help="how many contracts to look up concurrently")
+    parser.add_argument("--checkpoint", help="name of a file where to record contracts as they are looked up")
+    parser.add_argument(
+        "--resume", action="store_true", help="reuse contracts recorded in the checkpoint by a previous run")
+    parser.add_argument(
+        "--offline", action="store_true",
+        help="only use contracts recorded in the checkpoint, without contacting the contracts service")
+    parser.add_argument(
+        "--bulk", action="store_true",
+        help="delete all contracts with a single query per table, inside a transaction")
+    parser.add_argument(
+        "--batch-size", type=int,
+        help="with --bulk, how many contracts to delete in each transaction "
+             f"(all of them by default, or {STREAM_BATCH_SIZE} with --output-dir)")
+    parser.add_argument(
+        "--output-dir",
+        help="stream ids and write report sections to files in the given directory as contracts are looked up, "
+             "using bounded memory")
+    callstats.add_arguments(parser)
+    args = parser.parse_args()
+    callstats.setup(args)
+    if args.batch_size is not None and args.batch_size < 1:
+        parser.error("the batch size must be a positive integer")
+    if args.batch_size is not None and not args.bulk:
+        parser.error("--batch-size requires --bulk")
+    if args.jobs < 1:
+        parser.error("the number of jobs must be a positive integer")
+    if (args.resume or args.offline) and args.checkpoint is None:
+        parser.error("--resume and --offline require --checkpoint")
+    if args.file is None and not args.offline:
+        parser.error("the file argument is required unless --offline is provided")
+    return args
+
 
+def main(file, jobs, checkpoint_path, resume, offline, bulk, batch_size, output_dir):
+    try:
+        checkpoint = contractlib.Checkpoint(checkpoint_path, resume=resume, offline=offline)
+    except FileExistsError:
+        sys.exit(f"checkpoint {checkpoint_path} already exists: use --resume to continue from it")
+    except FileNotFoundError:
+        sys.exit(f"checkpoint {checkpoint_path} not found")
+    if output_dir is not None:
+        ids = checkpoint.ids("contract") if file is None else (line.strip() for line in file)
+        with checkpoint:
+            stream(ids, checkpoint, jobs, output_dir, bulk, batch_size or STREAM_BATCH_SIZE)
+        return
 
-def main(file):
-    ids = [line.strip() for line in file]
-    account_contracts = get_account_contracts(ids)
+    ids = checkpoint.ids("contract") if file is None else [line.strip() for line in file]
+    with checkpoint:
+        account_contracts, failed = get_account_contracts(ids, checkpoint, jobs=jobs)
     to_keep, to_delete, not_expiring, multiple_effective = split_contracts(account_contracts)
 
+    if failed:
+        print("\n* problematic contracts, lookup failed:\n")
+        for id in failed:
+            print(f"- {id}")
+
     if not_expiring:
         print("\n* problematic contracts, never expiring:\n")
         for contract in not_expiring:
-            print(f"- {contract.products} {contract.encoded_id}")
-            print(f"  {contract.id}")
-            print(f"  owned by {contract.account_name} ({contract.account_id})")
+            print(format_contract(contract, with_effective_to=False))
 
     if multiple_effective:
         print("\n* problematic contracts, multiple effective for the same account and product:\n")
         for contract in multiple_effective:
-            print(f"- {contract.products} {contract.encoded_id}")
-            print(f"  {contract.id}")
-            print(f"  effective to {contract.effective_to}")
-            print(f"  owned by {contract.account_name} ({contract.account_id})")
+            print(format_contract(contract))
 
     if to_keep:
         print("\n* contracts to keep:\n")
         for contract in to_keep:
-            print(f"- {contract.products} {contract.encoded_id}")
-            print(f"  {contract.id}")
-            print(f"  effective to {contract.effective_to}")
-            print(f"  owned by {contract.account_name} ({contract.account_id})")
+            print(format_contract(contract))
 
     if not to_delete:
         print("no contracts to delete")
@@ -138,18 +376,41 @@ def main(file):
 
     print("\n* contracts to delete:\n")
     for contract in to_delete:
-        print(f"{contract.encoded_id}  # {contract.products} owned by {contract.account_name} effective to {contract.effective_to}")
+        print(format_deleted_contract(contract))
 
     print("\n* queries:\n")
-    print("-- Queries are generated by running the script at")
-    print("-- https://github.com/frankban/yellow-tools/blob/master/contract-delete-duplicate-contracts.py")
+    print(QUERIES_HEADER)
     for contract in to_delete:
-        print(f"\n-- Delete {contract.products} contract {contract.encoded_id}")
-        print(f"-- owned by {contract.account_id} effective to {contract.effective_to}")
-        queries = get_delete_queries(contract.id)
-        print("\n".join(queries))
+        print("\n" + format_delete_comment(contract))
+        if not bulk:
+            queries = contractlib.get_delete_contract_queries(contract.id)
+            print("\n".join(queries))
+    if bulk:
+        queries = contractlib.get_bulk_delete_contract_queries(
+            [contract.id for contract in to_delete], batch_size=batch_size)
+        print("\n" + "\n".join(queries))
+
+
+def stream(ids, checkpoint, jobs, output_dir, bulk, batch_size):
+    """Look up and classify contracts with the given ids, writing sections to files in output_dir."""
+    report = StreamingReport(output_dir, bulk=bulk, batch_size=batch_size)
+    groups = ContractGroups(report)
+    try:
+        for num, id, contract in iter_contracts(ids, checkpoint, jobs=jobs):
+            if contract is None:
+                report.failed(id)
+            else:
+                groups.add(contract, num)
+        groups.close()
+    finally:
+        report.close()
+    for section, title in STREAM_TITLES.items():
+        print(f"{title}: {report.counts[section]} ({report.path(section)})")
+    print(f"queries: {report.path('queries')}")
 
 
 if __name__ == "__main__":
     args = setup()
-    main(args.file)
+    main(
+        args.file, args.jobs, args.checkpoint, args.resume, args.offline, args.bulk, args.batch_size,
+        args.output_dir)
@@ -2,50 +2,138 @@
 
 import argparse
 import collections
+from concurrent import futures
 import datetime
-import json
+import itertools
 import operator
 import subprocess
 import sys
+import time
+
+import callstats
+import contractlib
+import contractsapi
 
 
 # Renewal represents a renewal in ua-contracts.
 Renewal = collections.namedtuple(
     "Renewal", "id encoded_id status actionable start end contract_id sf_asset_id products account_id account_name sf_account_id")
 
-
-def run_contract(cmd, *args):
-    """Run the contract CLI with the given subcommnd and args."""
-    command = ("contract", cmd) + tuple(args)
-    return subprocess.check_output(command).decode("utf-8")
-
-
-def get_renewals(ids):
-    """Generate renewal objects from the given decoded ids."""
+# How many renewals to look up or wait contracts for, for each job.
+LOOKUP_WINDOW = 4
+
+
+def get_renewals(ids, checkpoint, jobs=1, stats=None):
+    """Generate renewal objects from the given decoded ids.
+
+    Renewals and their contracts are each looked up concurrently using the
+    given number of jobs, with at most LOOKUP_WINDOW renewals per job in
+    progress at any time, so that ids are consumed lazily, and renewals are
+    generated as soon as they and their contracts are ready. The
+    info about each contract is only retrieved once, however many renewals
+    share it, and renewals and contracts already in the given checkpoint are
+    not looked up again. Renewals whose lookup fails are reported and skipped.
+    If a counter is provided as stats, store there how many contract lookups
+    were requested ("contract lookups"), how many of them were already cached
+    ("contract cache hits") and how many renewals failed ("failed lookups").
+    """
+    if stats is None:
+        stats = collections.Counter()
     ids_len = len(ids)
-    for num, id in enumerate(ids):
-        print(f"{num}/{ids_len}", end="\r", file=sys.stderr)
-        encoded_id = run_contract("encode-id", "r", id).strip()
-        out = run_contract("show-renewal", encoded_id, "--format", "json")
-        info = json.loads(out)
-        contract_id = info["contractID"]
-        out = run_contract("show-contract", contract_id, "--format", "json")
-        account_contract_info = json.loads(out)
-        contract_info, account_info = account_contract_info["contractInfo"], account_contract_info["accountInfo"]
-        yield Renewal(
-            id=id,
-            encoded_id=info["id"],
-            status=info["status"],
-            actionable=info.get("actionable", False),
-            start=_parse_datetime(info["start"]),
-            end=_parse_datetime(info["end"]),
-            contract_id=contract_id,
-            sf_asset_id=_parse_sf_ids(info["externalAssetIDs"]),
-            products=contract_info['products'],
-            account_id=account_info["id"],
-            account_name=account_info["name"],
-            sf_account_id=_parse_sf_ids(account_info["externalAccountIDs"][0]),
-        )
+    ids = iter(ids)
+    window = jobs * LOOKUP_WINDOW
+    # Contracts are looked up by their own executor, so that each lookup
+    # starts as soon as its renewal is retrieved, without waiting for the
+    # renewal lookups already queued.
+    with futures.ThreadPoolExecutor(max_workers=jobs) as renewal_executor, \
+            futures.ThreadPoolExecutor(max_workers=jobs) as contract_executor:
+        # Map show-renewal futures to renewal ids, and show-contract futures to
+        # the list of renewal ids and info waiting for them.
+        renewal_fs, contract_fs, waiting = {}, {}, {}
+
+        def submit():
+            count = window - len(renewal_fs) - len(waiting)
+            for id in itertools.islice(ids, max(count, 0)):
+                renewal_fs[renewal_executor.submit(get_renewal_info, id, checkpoint)] = id
+
+        submit()
+        done_count = 0
+        while renewal_fs or waiting:
+            done, _ = futures.wait(set(renewal_fs).union(waiting), return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                if future in renewal_fs:
+                    id = renewal_fs.pop(future)
+                    try:
+                        info = future.result()
+                    except (subprocess.CalledProcessError, ValueError, LookupError) as err:
+                        print(f"cannot retrieve renewal {id}: {err!r}", file=sys.stderr)
+                        stats["failed lookups"] += 1
+                        continue
+                    contract_id = info["contractID"]
+                    stats["contract lookups"] += 1
+                    contract_future = contract_fs.get(contract_id)
+                    if contract_future is None:
+                        contract_future = contract_fs[contract_id] = contract_executor.submit(
+                            get_contract_info, contract_id, checkpoint)
+                    else:
+                        stats["contract cache hits"] += 1
+                    waiting.setdefault(contract_future, []).append((id, info))
+                    continue
+                renewals = waiting.pop(future)
+                try:
+                    account_contract_info = future.result()
+                except (subprocess.CalledProcessError, ValueError, LookupError) as err:
+                    for id, info in renewals:
+                        print(f"cannot retrieve contract for renewal {id}: {err!r}", file=sys.stderr)
+                    stats["failed lookups"] += len(renewals)
+                    continue
+                for id, info in renewals:
+                    done_count += 1
+                    print(f"{done_count}/{ids_len}", end="\r", file=sys.stderr)
+                    yield _make_renewal(id, info, account_contract_info)
+            submit()
+
+
+def get_renewal_info(id, checkpoint):
+    """Return the info about the renewal with the given decoded id, as returned by the contracts service.
+
+    The info is retrieved from the given checkpoint, or looked up and stored
+    there if not present.
+    """
+    def lookup(id):
+        return contractsapi.default_client().call("show-renewal", contractlib.encode_id("r", id))
+
+    return checkpoint.fetch("renewal", id, lookup)
+
+
+def get_contract_info(encoded_id, checkpoint):
+    """Return the info about the contract with the given encoded id, as returned by the contracts service.
+
+    The info is retrieved from the given checkpoint, or looked up and stored
+    there if not present.
+    """
+    def lookup(encoded_id):
+        return contractsapi.default_client().call("show-contract", encoded_id)
+
+    return checkpoint.fetch("contract", encoded_id, lookup)
+
+
+def _make_renewal(id, info, account_contract_info):
+    contract_info, account_info = account_contract_info["contractInfo"], account_contract_info["accountInfo"]
+    return Renewal(
+        id=id,
+        encoded_id=info["id"],
+        status=info["status"],
+        actionable=info.get("actionable", False),
+        start=_parse_datetime(info["start"]),
+        end=_parse_datetime(info["end"]),
+        contract_id=info["contractID"],
+        sf_asset_id=_parse_sf_ids(info["externalAssetIDs"]),
+        products=contract_info['products'],
+        account_id=account_info["id"],
+        account_name=account_info["name"],
+        sf_account_id=_parse_sf_ids(account_info["externalAccountIDs"][0]),
+    )
 
 
 def _parse_datetime(value):
@@ -64,37 +152,70 @@ def _parse_sf_ids(value):
 def setup():
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "file", type=argparse.FileType("r"),
-        help="name of a file containing a list of renewal ids separated by newlines")
-    return parser.parse_args()
-
-
-def main(file):
-    counter = collections.Counter()
-    ids = set(line.strip() for line in file)
-    for r in get_renewals(ids):
-        verb = "actionable" if r.actionable else "not actionable"
-        products = ", ".join(sorted(r.products))
-
-        counter["total"] += 1
-        counter[verb] += 1
-        counter[r.status] += 1
-        for product in r.products:
-            counter[product] += 1
-
-        print(f"\n# Delete {r.status} renewal {r.id}")
-        print(f"# (salesforce asset {r.sf_asset_id})")
-        print(f"# {verb} from {r.start} till {r.end}")
-        print(f"# for contract {r.contract_id} ({products})")
-        print(f"# owned by {r.account_name} ({r.account_id})")
-        print(f"# (salesforce account {r.sf_account_id})")
-        print(f"contract delete-renewal {r.encoded_id}")
+        "file", type=argparse.FileType("r"), nargs="?",
+        help="name of a file containing a list of renewal ids separated by newlines "
+             "(optional with --offline, in which case all recorded renewals are used)")
+    parser.add_argument("--jobs", type=int, default=1, help="how many renewals, and how many contracts, to look up concurrently")
+    parser.add_argument("--checkpoint", help="name of a file where to record renewals and contracts as they are looked up")
+    parser.add_argument(
+        "--resume", action="store_true", help="reuse renewals and contracts recorded in the checkpoint by a previous run")
+    parser.add_argument(
+        "--offline", action="store_true",
+        help="only use renewals and contracts recorded in the checkpoint, without contacting the contracts service")
+    callstats.add_arguments(parser)
+    args = parser.parse_args()
+    callstats.setup(args)
+    if args.jobs < 1:
+        parser.error("the number of jobs must be a positive integer")
+    if (args.resume or args.offline) and args.checkpoint is None:
+        parser.error("--resume and --offline require --checkpoint")
+    if args.file is None and not args.offline:
+        parser.error("the file argument is required unless --offline is provided")
+    return args
+
+
+def main(file, jobs, checkpoint_path, resume, offline):
+    start = time.monotonic()
+    try:
+        checkpoint = contractlib.Checkpoint(checkpoint_path, resume=resume, offline=offline)
+    except FileExistsError:
+        sys.exit(f"checkpoint {checkpoint_path} already exists: use --resume to continue from it")
+    except FileNotFoundError:
+        sys.exit(f"checkpoint {checkpoint_path} not found")
+    counter, stats = collections.Counter(), collections.Counter()
+    ids = set(checkpoint.ids("renewal") if file is None else (line.strip() for line in file))
+    with checkpoint:
+        for r in get_renewals(ids, checkpoint, jobs=jobs, stats=stats):
+            verb = "actionable" if r.actionable else "not actionable"
+            products = ", ".join(sorted(r.products))
+
+            counter["total"] += 1
+            counter[verb] += 1
+            counter[r.status] += 1
+            for product in r.products:
+                counter[product] += 1
+
+            print(f"\n# Delete {r.status} renewal {r.id}")
+            print(f"# (salesforce asset {r.sf_asset_id})")
+            print(f"# {verb} from {r.start} till {r.end}")
+            print(f"# for contract {r.contract_id} ({products})")
+            print(f"# owned by {r.account_name} ({r.account_id})")
+            print(f"# (salesforce account {r.sf_account_id})")
+            print(f"contract delete-renewal {r.encoded_id}")
 
     print("\ncounts:")
     for key, value in counter.items():
         print(f"  {key}: {value}")
 
+    lookups, hits = stats["contract lookups"], stats["contract cache hits"]
+    hit_rate = hits / lookups * 100 if lookups else 0
+    print("\nstats:")
+    print(f"  contract cache hits: {hits}/{lookups} ({hit_rate:.1f}%)")
+    if stats["failed lookups"]:
+        print(f"  failed lookups: {stats['failed lookups']}")
+    print(f"  wall time: {time.monotonic() - start:.2f}s")
+
 
 if __name__ == "__main__":
     args = setup()
-    main(args.file)
+    main(args.file, args.jobs, args.checkpoint, args.resume, args.offline)
@@ -0,0 +1,213 @@
+"""Helpers shared by the contract scripts.
+
+This module requires python3 and the contract CLI to be installed.
+"""
+
+from concurrent import futures
+import json
+import subprocess
+import threading
+
+import callstats
+
+
+# Define contract related tables, in the order rows must be deleted from them.
+CONTRACT_RELATED_TABLES = (
+    "contract_tokens",
+    "contract_products",
+    "contract_affordances",
+    "contract_allowances",
+    "contract_directives",
+    "contract_obligations",
+    "contract_external_asset_ids",
+    "contract_machines",
+    "contract_items",
+    "resource_access",
+)
+
+
+def run_contract(cmd, *args):
+    """Run the contract CLI with the given subcommnd and args."""
+    command = ("contract", cmd) + tuple(args)
+    with callstats.timed(f"contract {cmd}", " ".join(args)):
+        return subprocess.check_output(command).decode("utf-8")
+
+
+def quote(value):
+    """Return the given string as a quoted SQL literal."""
+    return "'" + value.replace("'", "''") + "'"
+
+
+def quote_array(values):
+    """Return the given strings as a quoted SQL array literal, e.g. '{"a","b"}'.
+
+    The literal is untyped, so that, like a scalar literal, it is resolved
+    against the type of the column it is compared to (e.g. with "= ANY(...)"),
+    rather than being a text array.
+    """
+    elements = ('"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"' for value in values)
+    return quote("{" + ",".join(elements) + "}")
+
+
+def batched(values, size=None):
+    """Generate lists of at most the given size from the given values.
+
+    If size is None, generate a single list with all the values.
+    """
+    values = list(values)
+    size = size or len(values) or 1
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def get_delete_contract_queries(id):
+    """Return a list of queries to be run to delete a contract with the given id."""
+    queries = [f"DELETE FROM {table} WHERE contract_id = {quote(id)};" for table in CONTRACT_RELATED_TABLES]
+    queries.append(f"DELETE FROM contracts WHERE id = {quote(id)};")
+    return queries
+
+
+def get_bulk_delete_contract_queries(ids, batch_size=None):
+    """Return a list of queries to be run to delete contracts with the given ids.
+
+    Each related table is cleaned up with a single query for each batch of at
+    most batch_size ids (or for all ids if batch_size is None), and each batch
+    is deleted in its own transaction.
+    """
+    queries = []
+    for batch in batched(ids, batch_size):
+        array = quote_array(batch)
+        queries.append("BEGIN;")
+        queries.extend(f"DELETE FROM {table} WHERE contract_id = ANY({array});" for table in CONTRACT_RELATED_TABLES)
+        queries.append(f"DELETE FROM contracts WHERE id = ANY({array});")
+        queries.append("COMMIT;")
+    return queries
+
+
+def encode_id(kind, id):
+    """Return the encoded version of the given decoded id of the given kind (e.g. "c")."""
+    return run_contract("encode-id", kind, id).strip()
+
+
+def decode_id(encoded_id):
+    """Return the decoded version of the given encoded id."""
+    return run_contract("decode-id", encoded_id).strip().strip("'")
+
+
+def encode_many(kind, ids, jobs=1):
+    """Return a list of encoded ids for the given decoded ids of the given kind.
+
+    Ids are encoded concurrently using the given number of jobs.
+    """
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(lambda id: encode_id(kind, id), ids))
+
+
+def decode_many(encoded_ids, jobs=1):
+    """Return a list of decoded ids for the given encoded ids.
+
+    Ids are decoded concurrently using the given number of jobs.
+    """
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(decode_id, encoded_ids))
+
+
+class Checkpoint:
+    """Record info about contracts, renewals etc. as returned by the contracts service.
+
+    Records are appended as JSON lines to the file at the given path as soon
+    as they are added, so that no lookup is lost if a run is interrupted. If
+    resume is True, the records already stored in the file are loaded and
+    reused, otherwise the file must not exist. If offline is True, records can
+    only be retrieved from the file, and the service is never contacted. If
+    path is None, records are not stored at all. Only the records loaded from
+    the file are kept in memory, so that memory does not grow with the number
+    of records added. Records can include the position of their id in the
+    input, so that ids can be listed in input order rather than in the order
+    lookups completed.
+    """
+
+    def __init__(self, path, resume=False, offline=False):
+        self.path = path
+        self.offline = offline
+        self._records = {}
+        # Map (kind, id) pairs to the position of the id in the input, if known.
+        self._positions = {}
+        self._lock = threading.Lock()
+        if offline:
+            resume = True
+        if path is None:
+            self._file = None
+            return
+        if resume:
+            try:
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # The last line can be truncated if a previous
+                            # run was killed while writing it.
+                            continue
+                        key = (record["kind"], record["id"])
+                        self._records[key] = record["info"]
+                        self._positions[key] = record.get("num")
+            except FileNotFoundError:
+                if offline:
+                    raise
+        self._file = None if offline else open(path, "a" if resume else "x")
+
+    def ids(self, kind):
+        """Return a list of the ids of the given kind (e.g. "contract") loaded from the file.
+
+        Ids are sorted by their position in the input, followed by the ones
+        recorded without a position, in the order they were recorded.
+        """
+        keys = [key for key in self._records if key[0] == kind]
+        num = self._positions.get
+        keys.sort(key=lambda key: (num(key) is None, num(key) or 0))
+        return [id for _, id in keys]
+
+    def get(self, kind, id):
+        """Return the info loaded from the file for the given kind and id, or None if not present."""
+        return self._records.get((kind, id))
+
+    def add(self, kind, id, info, num=None):
+        """Store the given info for the given kind and id in the file, if any.
+
+        If provided, num is the position of the id in the input.
+        """
+        if self._file is None:
+            return
+        record = {"kind": kind, "id": id, "info": info}
+        if num is not None:
+            record["num"] = num
+        line = json.dumps(record)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def fetch(self, kind, id, lookup, num=None):
+        """Return the info for the given kind and id.
+
+        If the info was not loaded, retrieve it by calling lookup(id) and store
+        it, with the given position in the input if any. Raise a LookupError if
+        the info was not loaded when offline.
+        """
+        info = self.get(kind, id)
+        if info is None:
+            if self.offline:
+                raise LookupError(f"{kind} {id} not found in checkpoint {self.path}")
+            info = lookup(id)
+            self.add(kind, id, info, num=num)
+        return info
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
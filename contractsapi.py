@@ -0,0 +1,71 @@
+"""Client for the contracts service, running the contract CLI.
+
+The service URL can be provided explicitly, or with the CONTRACTS_API_URL
+environment variable. Otherwise the CLI default is used.
+"""
+
+import collections
+import json
+import logging
+import os
+import subprocess
+import threading
+
+import callstats
+
+
+URL_ENV = "CONTRACTS_API_URL"
+
+# ContractStatus holds the contract info returned by the status command.
+ContractStatus = collections.namedtuple("ContractStatus", "id name account_id account_name resources")
+
+
+class Client:
+    """A contracts service client, safe to be used from multiple threads."""
+
+    def __init__(self, url=None):
+        self.url = url or os.environ.get(URL_ENV)
+
+    def call(self, cmd, *args):
+        """Return the JSON document for the given contract CLI subcommand and args."""
+        command = ("contract",)
+        if self.url:
+            command += ("--url", self.url)
+        command += (cmd,) + args + ("--format", "json")
+        logging.debug(f"executing: {' '.join(command)}")
+        with callstats.timed(f"contract {cmd}", " ".join(args)):
+            out = subprocess.check_output(command)
+        logging.debug(f"output: {out}")
+        return json.loads(out)
+
+    def status(self, contract_id):
+        """Return the status of the contract with the given id."""
+        info = self.call("status", contract_id)
+        return ContractStatus(
+            id=contract_id,
+            name=info["name"],
+            account_id=info["account-id"],
+            account_name=info["account-name"],
+            resources=tuple(res["name"] for res in info["resources"]),
+        )
+
+    def contract_token(self, contract_id):
+        """Return a token for attaching machines to the contract with the given id."""
+        return self.call("get-contract-token", contract_id)["contractToken"]
+
+    def resource_token(self, contract_id, machine_id, resource):
+        """Return the token for accessing the given resource from the given machine."""
+        return self.call("get-resource-token", contract_id, machine_id, resource)["resourceToken"]
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def default_client():
+    """Return a client shared by the whole process, configured from the environment."""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = Client()
+        return _default_client
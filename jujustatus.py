@@ -0,0 +1,155 @@
+"""Retrieve the status of the current Juju model.
+
+The status is retrieved by running "juju status", optionally filtered by
+patterns (machine ids, application or unit names), and cached for a short
+time in a file, so that running several tools one after the other does not
+query the controller each time. If ijson is installed, the JSON output is
+parsed incrementally, and only the requested top level keys are retained.
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+import callstats
+
+
+# How many seconds a cached status is valid for, by default.
+DEFAULT_TTL = 10
+
+_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'juju-status')
+
+
+def get_status(*patterns, keys=None, ttl=DEFAULT_TTL):
+    """Return the status of the current model as a dict.
+
+    If patterns are provided, only include the matching entities, as
+    "juju status" does. If keys are provided, only include the given top
+    level keys (e.g. "machines" or "applications"). A cached status is
+    returned if it was retrieved less than ttl seconds ago. If ttl is 0, the
+    cache is not used at all, and the status is always retrieved.
+    """
+    keys = None if keys is None else sorted(keys)
+    if ttl <= 0:
+        return _fetch(patterns, keys)
+    path = _cache_path(patterns, keys)
+    try:
+        if time.time() - os.path.getmtime(path) < ttl:
+            with open(path) as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    status = _fetch(patterns, keys)
+    _store(path, status)
+    return status
+
+
+def invalidate():
+    """Remove all cached statuses for the current model."""
+    prefix = _model_key() + '-'
+    try:
+        names = os.listdir(_CACHE_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.startswith(prefix):
+            try:
+                os.remove(os.path.join(_CACHE_DIR, name))
+            except FileNotFoundError:
+                pass
+
+
+def machines(status, agent_status=None):
+    """Generate (name, data) tuples for machines in the given status.
+
+    If agent_status is provided, only include machines whose agent has that
+    status (e.g. "down").
+    """
+    for name, data in status.get('machines', {}).items():
+        if agent_status is None or has_status(data, agent_status):
+            yield name, data
+
+
+def units(status, agent_status=None):
+    """Generate (name, data) tuples for units in the given status.
+
+    If agent_status is provided, only include units whose agent has that
+    status (e.g. "lost").
+    """
+    for app in status.get('applications', {}).values():
+        for name, data in app.get('units', {}).items():
+            if agent_status is None or has_status(data, agent_status):
+                yield name, data
+
+
+def has_status(data, status):
+    """Report whether the status found in the provided data matches status."""
+    juju_status = data.get('juju-status', {})
+    return juju_status.get('current') == status
+
+
+def _fetch(patterns, keys):
+    """Run juju status and return its output as a dict."""
+    cmd = ['juju', 'status', '--format', 'json'] + list(patterns)
+    with callstats.timed('juju status', ' '.join(patterns)):
+        return _run_status(cmd, keys)
+
+
+def _run_status(cmd, keys):
+    """Run the given juju status command and return the given top level keys of its output."""
+    if ijson is None:
+        output = subprocess.check_output(cmd)
+        status = json.loads(output.decode('utf-8'))
+        if keys is None:
+            return status
+        return {key: status[key] for key in keys if key in status}
+    status = {}
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+        try:
+            for key, value in ijson.kvitems(proc.stdout, '', use_float=True):
+                if keys is None or key in keys:
+                    status[key] = value
+        except Exception:
+            proc.kill()
+            raise
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return status
+
+
+def _model_key():
+    """Return a key identifying the current controller and model."""
+    with callstats.timed('juju switch'):
+        output = subprocess.check_output(['juju', 'switch'])
+    model = output.decode('utf-8').strip() + os.environ.get('JUJU_MODEL', '')
+    return hashlib.sha256(model.encode('utf-8')).hexdigest()[:16]
+
+
+def _cache_path(patterns, keys):
+    """Return the path of the cache file for the given query."""
+    query = json.dumps([patterns, keys]).encode('utf-8')
+    name = '{}-{}.json'.format(_model_key(), hashlib.sha256(query).hexdigest()[:16])
+    return os.path.join(_CACHE_DIR, name)
+
+
+def _store(path, status):
+    """Store the given status in the cache file at path."""
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        # The cache is only an optimization.
+        pass